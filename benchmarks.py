@@ -0,0 +1,349 @@
+# Benchmarks of the numerical functions in module.py. Run with: python benchmarks.py
+
+import time
+import numpy as np
+import pandas as pd
+from scipy.fft import fft, ifft, ifftshift
+import module as mod
+
+def timeit(func, *args, repeat = 3):
+    """ Measure the best execution time of a function over a few repetitions
+    Arguments:
+        func: function to time
+        args: arguments of the function
+        repeat: number of repetitions
+    Returns:
+        (best, result): tuple with the best time in [s] and the value returned by the function
+    """
+    best = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def calc_extremal_loop(vect, x_axis, tolerance):
+    """ Previous implementation of mod.calc_extremal, which builds a mask over the whole axis for every point (kept as a reference) """
+    vect_max = []
+    vect_min = []
+
+    dx = x_axis[1] - x_axis[0]
+
+    i = 0
+    while i < len(vect):
+        if vect[i] == np.max(vect[np.logical_and(x_axis > x_axis[i] - tolerance/2, x_axis < x_axis[i] + tolerance/2)]):
+            vect_max.append(i)
+            i += round(tolerance/(2 * dx))
+        elif vect[i] == np.min(vect[np.logical_and(x_axis > x_axis[i] - tolerance/2, x_axis < x_axis[i] + tolerance/2)]):
+            vect_min.append(i)
+            i += round(tolerance/(2 * dx))
+        else:
+            i += 1
+
+    return vect_max, vect_min
+
+def bench_extremal(resolutions = (0.04, 0.02, 0.01, 0.005, 0.0025), loop_max_dim = 12001):
+    """ Compare the scaling with the screen resolution of the extremal point detection, with the previous loop and with the sliding window
+    Arguments:
+        resolutions: list of resolutions of the screen in [cm]
+        loop_max_dim: largest number of points for which the (quadratic) loop is timed
+    Returns:
+        pandas dataframe with the number of points, the two times in [s] and whether the indices coincide
+    """
+    screen_size = 30 # [cm]
+    tolerance = 0.1 # [cm]
+    rng = np.random.default_rng(0)
+    rows = []
+
+    for dx in resolutions:
+        dim = int(screen_size/dx) + 1
+        screen = np.linspace(-screen_size/2, screen_size/2, dim)
+        pattern = np.sinc(screen / 25) ** 2 * (1 + 0.5 * np.cos(2 * np.pi * screen / 0.5)) + rng.normal(0, 0.01, dim) # Noisy fringes
+
+        t_window, res_window = timeit(mod.calc_extremal, pattern, screen, tolerance)
+        if dim <= loop_max_dim:
+            t_loop, res_loop = timeit(calc_extremal_loop, pattern, screen, tolerance, repeat = 1)
+            same = res_loop == res_window
+        else:
+            t_loop, same = np.nan, np.nan
+
+        rows.append([dim, t_loop, t_window, same])
+
+    return pd.DataFrame(rows, columns = ['dim', 'loop [s]', 'sliding window [s]', 'identical'])
+
+def synthetic_pattern(screen, slits_dist, vis, pha, slit_width, wavelen, dist_2, filter_width, avg_intensity, noise, rng):
+    """ Build a double slit pattern with known visibility and phase, with the normalization expected by mod.fast_process
+    Arguments:
+        screen: coordinates of the points on the screen in [cm]
+        slits_dist: distance between the slits in [mm]
+        vis: visibility of the fringes
+        pha: sign of the correlation function (1 or -1)
+        slit_width: width of the slits in [mm]
+        wavelen: wavelength of the light in [nm]
+        dist_2: distance from the double slit to the screen in [cm]
+        filter_width: width of the filter (only enters the normalization)
+        avg_intensity: average intensity of the speckle fields
+        noise: relative standard deviation of the multiplicative noise
+        rng: numpy random generator
+    Returns:
+        pandas dataframe in the same format of mod.read_pattern
+    """
+    dx = screen[1] - screen[0]
+    scale = avg_intensity * 2 * (slit_width / 10 / dx) ** 2 * (filter_width * dx) / (2 * np.pi)
+    k = slit_width / (wavelen * dist_2) * 1e6 # [1/cm]
+    f0 = slits_dist / (wavelen * dist_2) * 1e6 # [1/cm]
+    pattern = scale * np.sinc(k * screen) ** 2 * (1 + pha * vis * np.cos(2 * np.pi * f0 * screen)) * (1 + rng.normal(0, noise, len(screen)))
+
+    return pd.DataFrame({
+        'screen': screen,
+        'pattern': pattern,
+        'filter_type': 'Rectangular',
+        'filter_width': filter_width,
+        'slits_dist': slits_dist
+    })
+
+def compare_visibility(slits_dists = (0.5, 1, 2, 5, 10), visibilities = (0.1, 0.3, 0.5, 0.7, 0.9), noise = 0.05):
+    """ Compare accuracy and speed of the fit-based (mod.fast_process) and of the spectral (mod.spectral_process) visibility estimators,
+    on synthetic patterns with known visibility and phase
+    Arguments:
+        slits_dists: list of distances between the slits in [mm]
+        visibilities: list of true visibilities
+        noise: relative standard deviation of the multiplicative noise
+    Returns:
+        pandas dataframe with, for each method, the mean and maximum absolute error on the visibility, the fraction of
+        correct phases and the average time per pattern in [s]
+    """
+    slit_width = 0.2 # [mm]
+    wavelen = 500 # [nm]
+    dist_2 = 1e4 # [cm]
+    filter_width = 1
+    avg_intensity = 1
+    screen = np.linspace(-15, 15, 6001)
+    rng = np.random.default_rng(0)
+
+    methods = {'fit': lambda data: mod.fast_process(data, slit_width, wavelen, dist_2, avg_intensity),
+               'spectral': lambda data: mod.spectral_process(data, slit_width, wavelen, dist_2)}
+    errors = {name: [] for name in methods}
+    phases = {name: [] for name in methods}
+    times = {name: 0 for name in methods}
+
+    for d in slits_dists:
+        for v in visibilities:
+            for p in (1, -1):
+                data = synthetic_pattern(screen, d, v, p, slit_width, wavelen, dist_2, filter_width, avg_intensity, noise, rng)
+                for name, method in methods.items():
+                    t, (vis, pha) = timeit(method, data, repeat = 1)
+                    errors[name].append(abs(vis - v))
+                    phases[name].append(pha == p)
+                    times[name] += t
+
+    num = len(slits_dists) * len(visibilities) * 2
+    rows = [[name, np.mean(errors[name]), np.max(errors[name]), np.mean(phases[name]), times[name] / num] for name in methods]
+
+    return pd.DataFrame(rows, columns = ['method', 'mean error', 'max error', 'correct phase', 'time [s]'])
+
+def bench_batch_fit(sizes = (10, 100, 1000), noise = 0.05):
+    """ Compare the fit of a stack of patterns one by one (mod.fast_process) and all at once (mod.batch_process)
+    Arguments:
+        sizes: list of numbers of patterns in the stack
+        noise: relative standard deviation of the multiplicative noise of the synthetic patterns
+    Returns:
+        pandas dataframe with the number of patterns, the two times in [s] and the largest difference between the visibilities
+    """
+    slit_width = 0.2 # [mm]
+    wavelen = 500 # [nm]
+    dist_2 = 1e4 # [cm]
+    avg_intensity = 1
+    screen = np.linspace(-15, 15, 6001)
+    rng = np.random.default_rng(0)
+    rows = []
+
+    for num in sizes:
+        slits_dist = rng.uniform(0.5, 10, num)
+        filter_width = rng.uniform(1, 2, num)
+        data = [synthetic_pattern(screen, d, rng.uniform(0.1, 0.9), 1, slit_width, wavelen, dist_2, f, avg_intensity, noise, rng) 
+                for d, f in zip(slits_dist, filter_width)]
+        patterns = np.stack([pattern_data['pattern'].to_numpy() for pattern_data in data])
+
+        t_single, res_single = timeit(lambda: [mod.fast_process(pattern_data, slit_width, wavelen, dist_2, avg_intensity) for pattern_data in data], repeat = 1)
+        t_batch, res_batch = timeit(mod.batch_process, screen, patterns, slits_dist, filter_width, slit_width, wavelen, dist_2, avg_intensity, repeat = 1)
+
+        rows.append([num, t_single, t_batch, np.max(np.abs(np.array([r[0] for r in res_single]) - res_batch[0]))])
+
+    return pd.DataFrame(rows, columns = ['patterns', 'one by one [s]', 'batch [s]', 'max difference'])
+
+def bench_warm_start(slits_dists = np.linspace(0.5, 10, 40), filter_widths = (1, 1.5, 2), noise = 0.05):
+    """ Compare the fits of a sweep of patterns, each started from the grid search (cold) or from the previous pattern of the sweep (warm)
+    Arguments:
+        slits_dists: list of distances between the slits of the sweep in [mm]
+        filter_widths: list of filter widths of the sweep
+        noise: relative standard deviation of the multiplicative noise of the synthetic patterns
+    Returns:
+        pandas dataframe with, for each start, the total number of iterations and of function evaluations, the number of warm starts kept, the time 
+        in [s] and the largest difference of the visibilities from the cold start
+    """
+    slit_width = 0.2 # [mm]
+    wavelen = 500 # [nm]
+    dist_2 = 1e4 # [cm]
+    avg_intensity = 1
+    screen = np.linspace(-15, 15, 6001)
+    rng = np.random.default_rng(0)
+
+    data = [synthetic_pattern(screen, d, 0.9 * np.exp(-d * f / 10), 1, slit_width, wavelen, dist_2, f, avg_intensity, noise, rng) 
+            for f in filter_widths for d in slits_dists]
+
+    rows = []
+    for warm_start in (False, True):
+        t, (results, counts) = timeit(mod.sweep_process, data, slit_width, wavelen, dist_2, avg_intensity, warm_start, repeat = 1)
+        vis = np.array([r[0] for r in results])
+        if not warm_start:
+            vis_cold = vis
+        rows.append(['warm' if warm_start else 'cold', counts['nit'], counts['nfev'], counts['warm'], t, np.max(np.abs(vis - vis_cold))])
+
+    table = pd.DataFrame(rows, columns = ['start', 'nit', 'nfev', 'warm starts kept', 'time [s]', 'max difference'])
+    table['nit saved'] = table['nit'][0] - table['nit']
+    table['nfev saved'] = table['nfev'][0] - table['nfev']
+    return table
+
+def filter_unpadded(filter_type, fields, filter_width, dx):
+    """ Previous implementation of the filtering (mod.field_spectra and mod.filter_spectra), with the FFT on the 6001 points of the screen as they are, 
+    and the frequencies sampled from the shifted axis (kept as a reference) """
+    dim = fields.shape[-1]
+    kspace_size = 2 * np.pi/dx
+    kspace = np.linspace(-kspace_size / 2, kspace_size / 2, dim)
+
+    if filter_type == 'Rectangular':
+        profile = ifftshift((abs(kspace) <= filter_width/2).astype(float))
+    else:
+        profile = ifftshift(np.exp(-(kspace / filter_width) ** 2 / 2))
+
+    return ifft(fft(fields, axis = -1, workers = -1) * profile, axis = -1, workers = -1)
+
+def bench_filter(batches = (1, 16, 64, 256), filter_type = 'Gaussian', filter_width = 25):
+    """ Compare the throughput of the filtering of the fields with the FFT on the 6001 points of the screen and padded to mod.fft_length
+    Arguments:
+        batches: list of numbers of fields filtered together
+        filter_type: a string, either 'Gaussian' or 'Rectangular', determines the type of filtering
+        filter_width: width of the filter
+    Returns:
+        pandas dataframe with the number of fields, the fields filtered per second before and after, the speedup and the largest difference of the 
+        filtered fields in the central 10 cm of the screen (relative to their largest modulus)
+    """
+    config = mod.CONFIGS['Production']
+    screen = config.screen
+    rng = np.random.default_rng(0)
+    rows = []
+
+    for num in batches:
+        fields = np.array([mod.generate_speckle_field_fft(config, rng = rng)[0] for i in range(num)])
+        repeat = max(3, 256 // num)
+
+        t_before, res_before = timeit(filter_unpadded, filter_type, fields, filter_width, config.dx, repeat = repeat)
+        t_after, res_after = timeit(lambda: mod.filter_spectra(filter_type, mod.field_spectra(fields), filter_width, config), repeat = repeat)
+
+        center = np.abs(screen) <= 5
+        diff = np.max(np.abs(res_before - res_after)[..., center]) / np.max(np.abs(res_before))
+        rows.append([num, num / t_before, num / t_after, t_before / t_after, diff])
+
+    return pd.DataFrame(rows, columns = ['fields', 'before [fields/s]', 'after [fields/s]', 'speedup', 'max difference'])
+
+def bench_config(field_num = 400, filter_widths = (12.57, 25.13), slits_dists = np.arange(0.5, 3.5, 0.5), analysis_mode = 'Fourier sideband'):
+    """ Compare a whole sweep (FFT generation, filtering, propagation and analysis, with the streaming pipeline) on the preview and on the production 
+    grid, with the same fields
+    Arguments:
+        field_num: number of fields
+        filter_widths: list of the filter widths of the sweep
+        slits_dists: list of the slit separations of the sweep in [mm]
+        analysis_mode: visibility estimator (see mod.analyze_data)
+    Returns:
+        pandas dataframe with, for each grid, the number of points, the time of the sweep in [s], the mean jackknife error of the visibilities and 
+        their largest difference from the production grid
+    """
+    rows = []
+    for grid in ('Production', 'Preview'):
+        config = mod.CONFIGS[grid]
+
+        def sweep():
+            batches = mod.field_batches(mod.generate_speckle_fields(field_num, config, 'FFT synthesis', seed = 0))
+            for count, avg_intensity, pattern_groups in mod.stream_patterns(batches, config, 'Rectangular', filter_widths, slits_dists):
+                pass
+            return list(mod.stream_analysis(config, pattern_groups, 'Rectangular', filter_widths, slits_dists, avg_intensity, analysis_mode, 'Jackknife'))
+
+        t, results = timeit(sweep, repeat = 1)
+        vis = np.array([r[3] for r in results])
+        if grid == 'Production':
+            vis_production = vis
+        rows.append([grid, config.dim, t, np.mean([r[5] for r in results]), np.max(np.abs(vis - vis_production))])
+
+    return pd.DataFrame(rows, columns = ['grid', 'points', 'time [s]', 'mean error', 'max difference'])
+
+def bench_propagation(setups = ((0.005, 0.2), (0.005, 1), (0.0025, 2), (0.0025, 5)), field_num = 64, slits_dist = 10):
+    """ Compare the propagation of the fields to the screen with the direct sum (mod.PropagationOperator) and with the chirp-z transform in the Fresnel 
+    approximation (mod.FresnelOperator), for slits of different widths and grids of different resolutions
+    Arguments:
+        setups: list of pairs (resolution of the screen in [cm], width of the slits in [mm])
+        field_num: number of fields propagated together
+        slits_dist: distance between the slits in [mm]
+    Returns:
+        pandas dataframe with, for each set-up, the number of points of the slits, the time to build each operator and to compute the patterns of the 
+        fields in [s], the error measured by the Fresnel operator and the largest difference of the summed patterns relative to their maximum
+    """
+    rng = np.random.default_rng(0)
+    rows = []
+    for dx, slit_width in setups:
+        config = mod.SimulationConfig(dx = dx, slit_width = slit_width)
+        fields = rng.normal(size = (field_num, config.dim)) + 1j * rng.normal(size = (field_num, config.dim))
+        args = (config.dist_2, slits_dist, slit_width, config.screen, config.wavelen)
+
+        t_build_direct, direct = timeit(mod.PropagationOperator, *args)
+        t_build_fresnel, fresnel = timeit(mod.FresnelOperator, *args)
+        t_direct, pattern_direct = timeit(direct.patterns, fields)
+        t_fresnel, pattern_fresnel = timeit(fresnel.patterns, fields)
+        difference = np.max(np.abs(pattern_direct - pattern_fresnel)) / np.max(pattern_direct)
+        rows.append([dx, slit_width, len(direct.slit_index), t_build_direct, t_build_fresnel, t_direct, t_fresnel, fresnel.error, difference])
+
+    return pd.DataFrame(rows, columns = ['dx', 'slit width', 'slit points', 'build direct', 'build Fresnel', 'direct', 'Fresnel', 'error', 'difference'])
+
+def bench_generator(scatt_nums = (1000, 10000, 100000), field_num = 5):
+    """ Compare the generation of the speckle fields with the direct sum of the spherical waves (mod.generate_speckle_field) and through the angular 
+    spectrum of the source (mod.generate_speckle_field_angular), with the same scatterers
+    Arguments:
+        scatt_nums: list of numbers of scatterers of the source line
+        field_num: number of fields generated with each method
+    Returns:
+        pandas dataframe with, for each number of scatterers, the time per field of each method in [s], the error bound of the angular spectrum 
+        (largest error of the wave of a single scatterer), the largest difference between the fields and their rms value
+    """
+    rows = []
+    for scatt_num in scatt_nums:
+        config = mod.SimulationConfig(scatt_num = scatt_num)
+        operator = mod.angular_spectrum_operator(config) # Built before the timing, once per process
+
+        def generate(generator):
+            return np.array([generator(config, rng = np.random.default_rng(seed))[0] for seed in range(field_num)])
+
+        t_direct, direct = timeit(generate, mod.generate_speckle_field, repeat = 1)
+        t_angular, angular = timeit(generate, mod.generate_speckle_field_angular)
+        rows.append([scatt_num, t_direct / field_num, t_angular / field_num, operator.error, np.max(np.abs(direct - angular)), 
+                     np.sqrt(np.mean(np.abs(direct) ** 2))])
+
+    return pd.DataFrame(rows, columns = ['scatterers', 'direct', 'angular spectrum', 'error bound', 'max difference', 'rms field'])
+
+if __name__ == '__main__':
+    print('Extremal points detection')
+    print(bench_extremal())
+    print('Visibility estimators')
+    print(compare_visibility())
+    print('Fit of a stack of patterns')
+    print(bench_batch_fit())
+    print('Warm started fits along a sweep')
+    print(bench_warm_start())
+    print('Filtering of the fields (FFT length {} instead of 6001)'.format(mod.fft_length(6001)))
+    print(bench_filter())
+    print(bench_filter(filter_type = 'Rectangular'))
+    print('Whole sweep on the preview and on the production grid')
+    print(bench_config())
+    print('Propagation to the screen: direct sum and Fresnel FFT')
+    print(bench_propagation())
+    print('Generation of the speckle fields: direct sum and angular spectrum')
+    print(bench_generator())
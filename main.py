@@ -7,6 +7,8 @@ import module as mod # The plan is to put here the functions which do most of th
 import plotly.express as px
 import plotly.graph_objects as go
 import os
+import time
+import logging
 
 # The following imports are necessary for long callbacks
 from dash.long_callback import DiskcacheLongCallbackManager
@@ -107,7 +109,7 @@ def serve_layout():
                         # letting the user choose a pattern to analyze individually if necessary
                         dcc.Markdown('Choose sample field to plot')
                     ),
-                    dcc.Dropdown(os.listdir('Speckles')[:10], id = 'select-field-plot'),
+                    dcc.Dropdown(mod.list_speckles('Speckles')[:10], id = 'select-field-plot'),
                     html.Div([
                         html.Button(id='plot-field', children='Plot')
                     ],
@@ -189,6 +191,57 @@ def serve_layout():
                         # first part, and this should minimize spurious effects due to the source form and sharp edges. 
                         dcc.Markdown(r'The speckle field is generated with a monte carlo randomization, with $1000$ points on the source', mathjax = True)
                     ),
+                    html.Br(),
+                    html.Label(
+                        # The Huygens sum adds a spherical wave for each scatterer, while the FFT synthesis filters gaussian noise with the angular spectrum 
+                        # of the source, which gives the same statistics of fully developed speckle in a much shorter time. The angular spectrum mode 
+                        # sums the waves of the same scatterers as the Huygens sum with FFTs (same fields up to a checked error, cost independent of the 
+                        # number of scatterers but for the deposit on the source grid)
+                        dcc.Markdown('Generation method')
+                    ),
+                    dcc.RadioItems(
+                        ['Huygens sum', 'FFT synthesis', 'Angular spectrum'],
+                        'Huygens sum',
+                        id='generator-mode',
+                        inline=True
+                    ),
+                    html.Br(),
+                    html.Label(
+                        # The preview grid has half the resolution of the production one: the whole simulation runs a few times faster, to explore the 
+                        # parameters before a production sweep. The fields, the patterns and the analysis keep the grid of the fields
+                        dcc.Markdown(r'Grid of the screen: production ($0.05 \, \mathrm{mm}$ resolution) or preview ($0.1 \, \mathrm{mm}$)', mathjax = True)
+                    ),
+                    dcc.RadioItems(
+                        ['Production', 'Preview'],
+                        'Production',
+                        id='grid',
+                        inline=True
+                    ),
+                    html.Br(),
+                    html.Label(
+                        # Each field is generated with its own random stream, spawned from a master seed: with the same seed the same fields are generated, 
+                        # whatever the number of processes
+                        dcc.Markdown('Random seed (leave empty for a random one) and number of parallel processes')
+                    ),
+                    dcc.Input(id = 'seed', type = 'number', min = 0, step = 1, placeholder = 'random'),
+                    dcc.Slider(
+                        1,
+                        os.cpu_count(),
+                        step = 1,
+                        value = 1,
+                        id='workers'
+                    ),
+                    html.Label(
+                        # New fields can also be added to the ensemble already generated (with its parameters and seed): the patterns already 
+                        # calculated from it are then updated with the new fields only
+                        dcc.Markdown('Ensemble')
+                    ),
+                    dcc.RadioItems(
+                        ['New ensemble', 'Add to the ensemble'],
+                        'New ensemble',
+                        id='ensemble-mode',
+                        inline=True
+                    ),
                     
                 ],
                 className = 'right'
@@ -300,6 +353,45 @@ def serve_layout():
                     html.Label(
                         dcc.Markdown(r'The slits are 200 $\mu\mathrm{m}$ wide', mathjax = True)
                     ),
+                    html.Br(),
+                    html.Label(
+                        # The average pattern can be calculated summing the pattern of each field, or propagating the mutual coherence matrix of the 
+                        # ensemble at the slits, which gives the same result in a time independent of the number of fields. The cross-spectral density 
+                        # is the coherence matrix over the whole region of the slits, calculated once per filter width for all the slit separations
+                        dcc.Markdown('Calculation of the average pattern')
+                    ),
+                    dcc.RadioItems(
+                        ['Per-field sum', 'Coherence matrix', 'Cross-spectral density'],
+                        'Per-field sum',
+                        id='pattern-mode',
+                        inline=True
+                    ),
+                    html.Br(),
+                    html.Label(
+                        # The Fresnel FFT propagates each field with a chirp-z transform, O(N log N) whatever the width of the slits, while the direct 
+                        # sum has one term per point of the slits: it is faster only for wide slits or fine grids. It is checked against the direct sum 
+                        # on construction, which is used instead if the relative error is above 1e-3
+                        dcc.Markdown('Propagation from the double slit to the screen')
+                    ),
+                    dcc.RadioItems(
+                        ['Huygens sum', 'Fresnel FFT'],
+                        'Huygens sum',
+                        id='propagation-mode',
+                        inline=True
+                    ),
+                    html.Br(),
+                    html.Label(
+                        # In the adaptive mode the fields are added in blocks to each point of the sweep, until the standard error of its visibility 
+                        # (jackknife over groups of fields) is below the tolerance: the points far from the coherence edge need far fewer fields
+                        dcc.Markdown('Number of fields summed for each pattern, and tolerance on the standard error of the visibility (adaptive mode)')
+                    ),
+                    dcc.RadioItems(
+                        ['All the fields', 'Adaptive'],
+                        'All the fields',
+                        id='ensemble-size',
+                        inline=True
+                    ),
+                    dcc.Input(id = 'tolerance', type = 'number', min = 0, step = 0.001, value = 0.01),
                 ],
                 className = 'right_green'
                 ),
@@ -347,7 +439,7 @@ def serve_layout():
                         # letting the user choose a pattern to analyze individually if necessary
                         dcc.Markdown('> Choose pattern to view')
                     ),
-                    dcc.Dropdown(os.listdir('Patterns'), id = 'select-pattern'),
+                    dcc.Dropdown(mod.list_patterns('Patterns'), id = 'select-pattern'),
                     html.H3(children = 'PLOT'),
                     html.Div([
                         html.Button(id='plot-button', children='Plot')
@@ -450,6 +542,63 @@ def serve_layout():
                     ],
                     className = 'start'
                     ),
+                    html.Label(
+                        # The visibility can be obtained fitting the envelope of the maxima and minima (pattern by pattern, or for many patterns
+                        # at once with array operations), or from the ratio of the fringe sideband to the envelope in the spectrum of the pattern,
+                        # which needs no fit
+                        dcc.Markdown('Visibility estimator')
+                    ),
+                    dcc.RadioItems(
+                        ['Envelope fit', 'Batch envelope fit', 'Fourier sideband'],
+                        'Envelope fit',
+                        id='analysis-mode',
+                        inline=True
+                    ),
+                    html.Label(
+                        dcc.Markdown('Number of parallel processes')
+                    ),
+                    dcc.Slider(
+                        1,
+                        os.cpu_count(),
+                        step = 1,
+                        value = 1,
+                        id='analysis-workers'
+                    ),
+                    html.Label(
+                        # The uncertainty of the visibility is estimated analyzing replicas of each pattern, built from the partial sums of the pattern 
+                        # over groups of fields, leaving out one group at a time (jackknife) or resampling the groups (bootstrap)
+                        dcc.Markdown('Uncertainty of the visibility')
+                    ),
+                    dcc.RadioItems(
+                        ['None', 'Jackknife', 'Bootstrap'],
+                        'Jackknife',
+                        id='error-mode',
+                        inline=True
+                    ),
+                    html.H3(children = 'STREAMING PIPELINE'),
+                    html.Label(
+                        # The whole simulation (generation, filtering, interference and analysis) with the parameters chosen in all the tabs, streaming 
+                        # the fields in batches through each stage without writing them nor the patterns to disk, unless chosen below
+                        dcc.Markdown('Run the whole simulation in memory (only the visibilities are saved)')
+                    ),
+                    html.Div([
+                        html.Button(id='pipeline-button', children='Start pipeline'), 
+                        html.Button(id='cancel-pipeline', children = 'Cancel'),
+                    ],
+                    className = 'start'
+                    ),
+                    html.Div([
+                        html.P(id='counter-pipeline', children = 'Pipeline number 1'),
+                        html.Progress(id='progress-bar-pipeline')
+                    ],
+                    className = 'start'
+                    ),
+                    dcc.Checklist(
+                        ['Save the fields', 'Save the patterns'],
+                        [],
+                        id='pipeline-save',
+                        inline=True
+                    ),
                     html.H3(children = 'PLOT VISIBILITY'),
                     html.Div([
                         html.Button(id='plot-all-button', children = 'Plot')
@@ -565,6 +714,11 @@ def update_values(a, c, d):
         # The other parameters are passed as states, so changing them does not trigger the start of the simulation,
         State('field-number', 'value'),
         # State('correlation-length', 'value'),
+        State('generator-mode', 'value'),
+        State('seed', 'value'),
+        State('workers', 'value'),
+        State('ensemble-mode', 'value'),
+        State('grid', 'value'),
     ],
     running=[ # When the simulation is running,
         (Output('part-one-button', 'disabled'), True, False), # The start button is disabled
@@ -584,29 +738,52 @@ def update_values(a, c, d):
     progress = [Output('progress-bar-one', 'value'), Output('progress-bar-one', 'max')], # Link to progress bar id
     manager = long_callback_manager
 )
-def generate_fields(set_progress, n_clicks, field_num):
+def generate_fields(set_progress, n_clicks, field_num, generator_mode, seed, workers, ensemble_mode, grid):
     if n_clicks is None:
         raise exceptions.PreventUpdate() # This is necessary in order for the simulation not to start automatically upon launching the app
     
-    source_size = 0.5
-    dist = 15
-    scatt_num = 1000
-    wavelen = 500
+    config = mod.CONFIGS[grid] # Grid of the screen and geometry of the set-up
     avg_intensity = 0
 
-    for i in range(field_num):
-        field, screen = mod.generate_speckle_field(source_size, dist, scatt_num, wavelen) # Generate a field
+    store = None
+    first = 0 # Number of fields already in the ensemble
+
+    if ensemble_mode == 'Add to the ensemble' and os.path.exists(mod.speckle_store('Speckles') + '.json'):
+        # Continue the ensemble with its own configuration and seed, which are checked before the store is extended
+        if mod.ensemble_identity('Speckles') is None:
+            return ['The ensemble cannot be extended, its generator and seed were not recorded (imported or older fields): generate a new ensemble']
+        store, header, first = mod.append_speckle_store('Speckles', field_num)
+        config = mod.SimulationConfig.from_header(header)
+        generator_mode, seed = header['generator_mode'], header['seed']
+
+        with open('numbers.txt', 'r') as f: # Sum over the fields, the new ones are added to it
+            avg_intensity = float(f.read())
+    elif seed is None:
+        seed = int(np.random.SeedSequence().entropy) # Draw the seed here, so that it is stored and the ensemble can be continued
+
+    # Generate the fields (in parallel, if more than one process is chosen)
+    fields = mod.generate_speckle_fields(field_num, config, generator_mode, seed, workers, first)
+
+    for i, (field, screen) in enumerate(fields):
+        if store is None: # Create the binary store of the ensemble (it replaces the previous one, whose patterns are not updated any more)
+            mod.detach_patterns('Patterns')
+            store, header = mod.create_speckle_store('Speckles', field_num, config, {
+                'generator_mode': generator_mode,
+                'seed': seed
+            })
         avg_intensity += np.mean(np.abs(field).real ** 2)
-        field_data = pd.DataFrame({
-            'screen': screen, 
-            'spec_re': field.real, 
-            'spec_im': field.imag
-        }) # Create a data frame
-        field_data.to_csv('Speckles/speckle_num_{}.csv'.format(i)) # Store in csv
+        store[first + i] = field # Store the field
+        store.flush()
+        header['complete'] = first + i + 1
+        mod.write_header(mod.speckle_store('Speckles'), header)
+        with open('numbers.txt', 'w') as f: # Kept in step with the complete fields, in case the generation is cancelled
+            f.write(str(avg_intensity))
         set_progress((str(i + 1), str(field_num))) # Update progress bar
 
-    with open('numbers.txt', 'w') as f:
-        f.write(str(avg_intensity))
+    if first > 0:
+        # Add the new fields to the patterns calculated from the previous ones (the patterns are sums over the fields)
+        for updated, total in mod.update_patterns('Patterns', store[first:], first, mod.ensemble_identity('Speckles')):
+            set_progress((str(updated), str(total)))
 
     return ['Simulation number {}'.format(n_clicks + 1)] # Return counter
 
@@ -621,6 +798,10 @@ def generate_fields(set_progress, n_clicks, field_num):
         State('filtering-type', 'value'),
         State('filter-width', 'value'),
         State('slits-dist', 'value'),
+        State('pattern-mode', 'value'),
+        State('ensemble-size', 'value'),
+        State('tolerance', 'value'),
+        State('propagation-mode', 'value'),
     ],
     running=[ # This is identical to above
         (Output('part-two-button', 'disabled'), True, False),
@@ -640,60 +821,139 @@ def generate_fields(set_progress, n_clicks, field_num):
     progress=[Output('progress-bar-two', 'value'), Output('progress-bar-two', 'max')],
     manager=long_callback_manager
 )
-def filter_and_interfere(set_progress, n_clicks, filter_type, filter_width_ext, slits_dist_ext):
+def filter_and_interfere(set_progress, n_clicks, filter_type, filter_width_ext, slits_dist_ext, pattern_mode, ensemble_size, tolerance, 
+                         propagation_mode):
     if n_clicks is None:
         raise exceptions.PreventUpdate()
 
-    slit_width = 0.2
-    dist_2 = 1e4
-    wavelen = 500
-    screen_size = 30 # [cm] 
-    dx = 0.005 # [cm] (resolution)
-    dim = int(screen_size/dx) + 1 # Dimension of the arrays
+    config = mod.ensemble_config('Speckles').replace(propagation = propagation_mode) # The patterns are calculated on the grid of the fields
+    wavelen = config.wavelen
+    dim = config.dim # Dimension of the arrays
 
     filter_width_ext = [round(g * 2e5 * np.pi / wavelen, 2) for g in filter_width_ext]
 
     filter_width_step = round(0.01 * 2e5 * np.pi / wavelen, 2)
     slits_dist_step = 0.5
 
-    vect = os.listdir('Speckles')
+    fields, screen = mod.open_speckles('Speckles') # Open the whole ensemble only once (memory mapped), it is the same for every point of the sweep
+    spectra = mod.spectrum_cache('Speckles') # The spectra of the fields are calculated once and reused for every filter width (and by later runs)
     
-    num = (filter_width_ext[1] + filter_width_step - filter_width_ext[0]) * (slits_dist_ext[1] + slits_dist_step - slits_dist_ext[0]) / (filter_width_step * slits_dist_step)
+    filter_widths = np.arange(filter_width_ext[0], filter_width_ext[1] + filter_width_step, filter_width_step)
+    slits_dists = np.arange(slits_dist_ext[0], slits_dist_ext[1] + slits_dist_step, slits_dist_step)
+    num = len(filter_widths) * len(slits_dists)
+
+    # All the patterns of the run are stored in a single binary store, one per row
+    groups = 10 # The fields are split in groups, whose partial sums of the patterns give the uncertainties of the analysis (jackknife or bootstrap)
+    adaptive = ensemble_size == 'Adaptive'
+    if adaptive and tolerance is None: # The input is empty (or not valid): use its default, as the seed is drawn when it is empty
+        tolerance = 0.01
+    block = 50 # In the adaptive mode, number of fields added at a time
+    min_fields = 100 # and number of fields before the first check of the standard error, which is repeated each time the fields have doubled
+
+    run_header = {'field_num': len(fields), 'groups': groups}
+    if adaptive:
+        run_header.update(tolerance = tolerance, field_count = [len(fields) for i in range(num)]) # Fields used by each pattern, set below
+    patterns, header = mod.create_pattern_store('Patterns', n_clicks, config, filter_type, np.repeat(filter_widths, len(slits_dists)), 
+                                                np.tile(slits_dists, len(filter_widths)), run_header, mod.ensemble_identity('Speckles'))
+    group_store = mod.create_statistics_store('Patterns', n_clicks, 'groups', (num, groups, dim))
+    if pattern_mode == 'Per-field sum': # Only in this case the pattern of each field is calculated, and its variance over the fields can be stored
+        variance_store = mod.create_statistics_store('Patterns', n_clicks, 'variance', (num, dim))
     counter = 1
 
-    for filter_width in np.arange(filter_width_ext[0], filter_width_ext[1] + filter_width_step, filter_width_step):
-        for slits_dist in np.arange(slits_dist_ext[0], slits_dist_ext[1] + slits_dist_step, slits_dist_step):
-
-            pattern = np.zeros(dim) # Array containing the interference pattern
+    for filter_width in filter_widths:
+        pattern_groups = np.zeros((len(slits_dists), groups, dim)) # Arrays containing the partial sums of the interference patterns for this filter width
+        operators = [config.operator(slits_dist) for slits_dist in slits_dists] # Built once per geometry
+        coherence = [[0 for g in range(groups)] for slits_dist in slits_dists] # Mutual coherence matrices at the slits, for each group of fields
+        region = mod.aperture_region(screen, np.max(slits_dists), config.slit_width) # Region of the slits, for all the slit separations
+        csd = [0 for g in range(groups)] # Cross-spectral density over the region, for each group of fields
+        stats = [(0, 0, 0) for slits_dist in slits_dists] # Streaming mean and square deviations of the patterns (number of fields, mean, m2)
+        active = np.ones(len(slits_dists), dtype = bool) # Points of the sweep which still need fields (all of them, unless adaptive)
+        used = np.zeros(len(slits_dists), dtype = int) # Number of fields summed for each point
+
+        def group_patterns(j):
+            # Partial sums of the pattern of a point over the groups of fields, from the coherence matrices of the groups
+            for g in range(groups):
+                if pattern_mode == 'Coherence matrix':
+                    pattern_groups[j, g] = operators[j].coherence_pattern(coherence[j][g]) # Sum of the patterns of the whole group in one step
+                elif pattern_mode == 'Cross-spectral density':
+                    pattern_groups[j, g] = operators[j].csd_pattern(csd[g], region) # The coherence matrix at the slits is a block of the cross-spectral density
+
+        start = 0
+        next_check = min_fields # Number of fields of the next check (the checks are geometrically spaced, so that their cost is a fraction of the sum)
+        for transf in spectra:
+            for first in range(0, len(transf), block if adaptive else len(transf)):
+                chunk = transf[first:first + block] if adaptive else transf
+                filt_fields = mod.filter_spectra(filter_type, chunk, filter_width, config) # Spatially filter a block of fields, only once for all the slit separations
+                members = mod.group_matrix(start, len(filt_fields), groups) # Group of each field of the block
+                start += len(filt_fields)
+                used[active] = start
+
+                if pattern_mode == 'Cross-spectral density':
+                    for g in range(groups): # Accumulate the cross-spectral density of the ensemble, once for all the slit separations
+                        csd[g] = csd[g] + mod.cross_spectral_density(filt_fields[members[g] > 0], region)
+
+                for j in np.flatnonzero(active):
+                    if pattern_mode == 'Coherence matrix':
+                        for g in range(groups): # Accumulate the coherence matrix of the ensemble
+                            coherence[j][g] = coherence[j][g] + operators[j].coherence(filt_fields[members[g] > 0])
+                    elif pattern_mode == 'Per-field sum':
+                        field_patterns = operators[j].patterns(filt_fields)
+                        pattern_groups[j] += members @ field_patterns # Add the patterns generated by the block of fields to the average
+                        stats[j] = mod.welford_update(*stats[j], field_patterns)
+
+                if adaptive and start >= next_check:
+                    next_check = 2 * start
+                    for j in np.flatnonzero(active): # The points whose visibility is precise enough are left as they are
+                        group_patterns(j)
+                        if mod.ensemble_error(config, pattern_groups[j], slits_dists[j], filter_width) < tolerance:
+                            active[j] = False
+
+                if not active.any():
+                    break
+            if not active.any():
+                break
+
+        for j in np.flatnonzero(active):
+            group_patterns(j)
+
+        # The patterns are sums over the fields: those of the points which used fewer fields are scaled to the whole ensemble
+        pattern_groups *= (len(fields) / used)[:, None, None]
+
+        for j, pattern in enumerate(pattern_groups.sum(axis = 1)):
+            # Store the pattern and its statistics
+            patterns[counter - 1] = pattern
+            group_store[counter - 1] = pattern_groups[j]
+            if pattern_mode == 'Per-field sum':
+                count, mean, m2 = stats[j]
+                variance_store[counter - 1] = m2 / max(count - 1, 1)
+                variance_store.flush()
+            patterns.flush()
+            group_store.flush()
+            header['complete'] = counter
+            if adaptive:
+                header['field_count'][counter - 1] = int(used[j])
+            mod.write_header('Patterns/patterns_{}'.format(n_clicks), header)
 
-            for i in vect:
-                field_data = pd.read_csv('Speckles/' + i) # Read the csv with the speckle field 
-                field = field_data['spec_re'].to_numpy() + field_data['spec_im'].to_numpy() * 1j # Convert to ndarray
-                screen = field_data['screen'].to_numpy() 
-                filt_field = mod.filter(filter_type, field, filter_width) # Spatially filter the field
+            counter += 1
+            set_progress((str(counter), str(num))) # Update progress bar
 
-                # Add the pattern generated by the speckle field to the average
-                pattern += mod.create_pattern(filt_field, dist_2, slits_dist, slit_width, screen, wavelen) 
+    pattern_data = pd.DataFrame({
+        'screen': screen,
+        'pattern': pattern
+    }) # Convert to data frame
 
-            pattern_data = pd.DataFrame({
-                'screen': screen,
-                'pattern': pattern,
-                'filter_type': [filter_type for i in range(len(screen))],
-                'filter_width': [round(filter_width, 2) for i in range(len(screen))],
-                'slits_dist': [slits_dist for i in range(len(screen))]
-            }) # Convert to data frame
+    # fig = px.line(pattern_data.melt(id_vars = 'screen', value_vars = ['profile', 'pattern']), x = 'screen', y = 'value', title = 'Averaged interference pattern', line_group = 'variable', color = 'variable') 
+    fig = px.line(pattern_data, x = 'screen', y = 'pattern', title = 'Averaged interference pattern', labels  = {
+        'screen': 'x [cm]',
+        'pattern': 'Field intensity'
+    }) # Create the figure of the graph of the last pattern
 
-            # fig = px.line(pattern_data.melt(id_vars = 'screen', value_vars = ['profile', 'pattern']), x = 'screen', y = 'value', title = 'Averaged interference pattern', line_group = 'variable', color = 'variable') 
-            fig = px.line(pattern_data, x = 'screen', y = 'pattern', title = 'Averaged interference pattern', labels  = {
-                'screen': 'x [cm]',
-                'pattern': 'Field intensity'
-            }) # Create the figure of the graph
-            pattern_data.to_csv('Patterns/Pattern_{}_{}.csv'.format(n_clicks, counter)) # Store the pattern to csv
+    message = 'Simulation number {}'.format(n_clicks + 1)
+    if adaptive: # Report how many fields were needed
+        message += ' (fields used per pattern: min {}, mean {:.0f}, max {} of {})'.format(min(header['field_count']), np.mean(header['field_count']), 
+                                                                                        max(header['field_count']), len(fields))
 
-            counter += 1
-            set_progress((str(counter), str(num))) # Update progress bar
-
-    return ['Simulation number {}'.format(n_clicks + 1)], fig # Return the number of clicks and the last pattern computed
+    return [message], fig # Return the number of clicks and the last pattern computed
 
 @callback(
     # This is the callback for the plot of an individual pattern in the data analysis part. A long callback isn't necessary here
@@ -707,13 +967,14 @@ def plot_pattern(n_clicks, patt_name):
     if n_clicks is None:
         raise exceptions.PreventUpdate()
     
-    pattern_data = pd.read_csv('Patterns/' + patt_name) # Read the pattern from csv
+    pattern_data = mod.read_pattern('Patterns', patt_name) # Read the pattern
+    fields = ', fields summed: {}'.format(pattern_data['field_count'][0]) if 'field_count' in pattern_data else '' # Adaptive runs only
     fig = px.line(pattern_data, x = 'screen', y = 'pattern', title = 'Interference pattern', labels = {
         'screen': 'x [cm]',
         'pattern': 'Field intensity'
     }) # Create the figure
 
-    return fig, ['Plot number {}'.format(n_clicks + 1)], ['Filter type: ' + pattern_data['filter_type'][0] + ', filter width: {}'.format(pattern_data['filter_width'][0]) + r'$\, \mathrm{cm}^{-1}$' + ', slit separation: {}'.format(pattern_data['slits_dist'][0]) + r'$\, \mathrm{mm}$']
+    return fig, ['Plot number {}'.format(n_clicks + 1)], ['Filter type: ' + pattern_data['filter_type'][0] + ', filter width: {}'.format(pattern_data['filter_width'][0]) + r'$\, \mathrm{cm}^{-1}$' + ', slit separation: {}'.format(pattern_data['slits_dist'][0]) + r'$\, \mathrm{mm}$' + fields]
 
 @callback(
     # This is the callback for the plot of an individual pattern in the data analysis part. A long callback isn't necessary here
@@ -726,8 +987,11 @@ def plot_field(n_clicks, field_name):
     if n_clicks is None:
         raise exceptions.PreventUpdate()
     
-    field_data = pd.read_csv('Speckles/' + field_name) # Read the pattern from csv
-    data_spec = pd.concat([field_data['screen'], (field_data['spec_re'] ** 2 + field_data['spec_im'] ** 2).rename('spec')], axis = 1)
+    field, screen = mod.read_speckle('Speckles', field_name) # Read the field
+    data_spec = pd.DataFrame({
+        'screen': screen,
+        'spec': np.abs(field) ** 2
+    })
 
     fig = px.line(data_spec, x = 'screen', y = 'spec', title = 'Speckle field', labels = {
         'screen': 'x [cm]',
@@ -751,11 +1015,10 @@ def analyze(n_clicks, patt_name, guess, A_1):
     if n_clicks is None:
         raise exceptions.PreventUpdate()
     
-    slit_width = 0.2 # [mm]
-    wavelen = 500 # [nm]
-    dist_2 = 1e4 # [cm]
+    config = mod.read_config('Patterns', patt_name) # Geometry with which the pattern was calculated
+    slit_width, wavelen, dist_2 = config.slit_width, config.wavelen, config.dist_2
 
-    pattern_data = pd.read_csv('Patterns/' + patt_name) # Read the pattern from csv
+    pattern_data = mod.read_pattern('Patterns', patt_name) # Read the pattern
 
     patt_data_proc, patt_data_norm, vis = mod.process_pattern(pattern_data, slit_width, wavelen, dist_2, guess, A_1)
     
@@ -806,11 +1069,10 @@ def pre_process(n_clicks, options, guess, A_1, patt_name):
     if n_clicks is None:
         raise exceptions.PreventUpdate()
 
-    slit_width = 0.2 # [mm]
-    wavelen = 500 # [nm]
-    dist_2 = 1e4 # [cm]
+    config = mod.read_config('Patterns', patt_name) # Geometry with which the pattern was calculated
+    slit_width, wavelen, dist_2 = config.slit_width, config.wavelen, config.dist_2
 
-    pattern_data = pd.read_csv('Patterns/' + patt_name) # Read the pattern from csv
+    pattern_data = mod.read_pattern('Patterns', patt_name) # Read the pattern
 
     fig_data, fig_layout = mod.pre_process(pattern_data, slit_width, wavelen, dist_2, options, guess, A_1)
 
@@ -818,6 +1080,55 @@ def pre_process(n_clicks, options, guess, A_1, patt_name):
 
     return fig, 'Run number {}'.format(n_clicks + 1)
 
+def save_correlation(results, num, set_progress):
+    """ Collect the results of the analysis of the patterns, mirrored by symmetry, and save them in corr_data.csv
+    Arguments:
+        results: iterable of tuples (slits_dist, filter_width, filter_type, vis, pha, err), one per pattern
+        num: number of patterns
+        set_progress: function updating the progress bar
+    """
+    visib = []
+    filter_width = []
+    slits_dist = []
+    phase = []
+    filter_type = []
+    error = []
+
+    last_update = 0
+    for counter, (s, f, t, vis, pha, err) in enumerate(results, 1):
+        vis = round(float(vis), 3) # The estimators return the visibility in full precision
+        slits_dist.append(round(s, 2))
+        filter_width.append(round(f, 2))
+        visib.append(vis)
+        phase.append(pha)
+        filter_type.append(t)
+        error.append(err)
+
+        # Mirror the data by symmetry
+        slits_dist.append(-round(s, 2))
+        filter_width.append(round(f, 2))
+        visib.append(vis)
+        phase.append(pha)
+        filter_type.append(t)
+        error.append(err)
+
+        if counter == num or time.perf_counter() - last_update > 0.5: # Update the progress bar at most twice a second
+            set_progress((str(counter), str(num)))
+            last_update = time.perf_counter()
+                     
+    data = pd.DataFrame({
+        'slits_dist': slits_dist,
+        'filter_width': filter_width,
+        'corr': visib,
+        'corr_err': error,
+        'phase': phase,
+        'filter_type': filter_type
+    })
+    
+    data.to_csv('corr_data.csv')
+
+    # fig = px.scatter(data, x = 'slits_dist', y = 'vis', title = 'Visibility', color = 'filter_width')
+
 @app.long_callback( 
     # This is the callback for the first simulation. Long callback since for regular callbacks there's a max time of 30 s.
     # Also, long callback allows to manage the layout during the function call
@@ -829,6 +1140,9 @@ def pre_process(n_clicks, options, guess, A_1, patt_name):
         Input('part-three-button', 'n_clicks'), # The only input is the click of the 'start' button
         # The other parameters are passed as states, so changing them does not trigger the start of the simulation,
         # State('select-pattern', 'value')
+        State('analysis-mode', 'value'),
+        State('analysis-workers', 'value'),
+        State('error-mode', 'value'),
     ],
     running=[ # When the simulation is running,
         (Output('part-three-button', 'disabled'), True, False), # The start button is disabled
@@ -848,53 +1162,104 @@ def pre_process(n_clicks, options, guess, A_1, patt_name):
     progress = [Output('progress-bar-three', 'value'), Output('progress-bar-three', 'max')], # Link to progress bar id
     manager = long_callback_manager
 )
-def analyze_all(set_progress, n_clicks):
+def analyze_all(set_progress, n_clicks, analysis_mode, workers, error_mode):
     if n_clicks is None:
         raise exceptions.PreventUpdate()
     
-    vect = os.listdir('Patterns')
+    vect = mod.list_patterns('Patterns')
     num = len(vect)
 
-    slit_width = 0.2 # [mm]
-    wavelen = 500 # [nm]
-    dist_2 = 1e4 # [cm]
+    # The patterns are analyzed on a pool of processes (each with the configuration of its run), the results come back in the order of vect. When 
+    # the cancel button is pressed the process running this callback is stopped together with the pool, which only has a few tasks queued
+    results = mod.analyze_patterns('Patterns', vect, analysis_mode, workers, error_mode = error_mode)
 
-    visib = []
-    filter_width = []
-    slits_dist = []
-    phase = []
-    
-    counter = 1
-    for i in vect:
-        data_temp = pd.read_csv('Patterns/' + i)
-        vis, pha = mod.fast_process(data_temp, slit_width, wavelen, dist_2)
+    save_correlation(results, num, set_progress)
 
-        slits_dist.append(round(data_temp['slits_dist'][0], 2))
-        filter_width.append(round(data_temp['filter_width'][0], 2))
-        visib.append(vis)
-        phase.append(pha)
+    return ['Analysis number {}'.format(n_clicks + 1)]
 
-        # Mirror the data by symmetry
-        slits_dist.append(-round(data_temp['slits_dist'][0], 2))
-        filter_width.append(round(data_temp['filter_width'][0], 2))
-        visib.append(vis)
-        phase.append(pha)
+@app.long_callback( 
+    # This is the callback for the streaming pipeline, which runs the three parts of the simulation one after the other on batches of fields
+    output = [
+        Output('counter-pipeline', 'children'),
+    ],
+    inputs = [
+        Input('pipeline-button', 'n_clicks'),
+        # The parameters are the ones chosen in the other tabs
+        State('field-number', 'value'),
+        State('generator-mode', 'value'),
+        State('seed', 'value'),
+        State('workers', 'value'),
+        State('filtering-type', 'value'),
+        State('filter-width', 'value'),
+        State('slits-dist', 'value'),
+        State('analysis-mode', 'value'),
+        State('error-mode', 'value'),
+        State('pipeline-save', 'value'),
+        State('grid', 'value'),
+        State('propagation-mode', 'value'),
+    ],
+    running=[
+        (Output('pipeline-button', 'disabled'), True, False),
+        (Output('cancel-pipeline', 'disabled'), False, True),
+        (
+            Output('counter-pipeline', 'style'),
+            {'visibility': 'hidden'},
+            {'visibility': 'visible'},
+        ),
+        (
+            Output('progress-bar-pipeline', 'style'),
+            {'visibility': 'visible'},
+            {'visibility': 'hidden'},
+        ),
+    ],
+    cancel = [Input('cancel-pipeline', 'n_clicks')],
+    progress = [Output('progress-bar-pipeline', 'value'), Output('progress-bar-pipeline', 'max')],
+    manager = long_callback_manager
+)
+def run_pipeline(set_progress, n_clicks, field_num, generator_mode, seed, workers, filter_type, filter_width_ext, slits_dist_ext, analysis_mode, 
+                 error_mode, save, grid, propagation_mode):
+    if n_clicks is None:
+        raise exceptions.PreventUpdate()
 
-        set_progress((str(counter), str(num)))
-                     
-    data = pd.DataFrame({
-        'slits_dist': slits_dist,
-        'filter_width': filter_width,
-        'corr': visib,
-        'phase': phase,
-        'filter_type': [data_temp['filter_type'][0] for i in range(len(slits_dist))]
-    })
-    
-    data.to_csv('corr_data.csv')
+    config = mod.CONFIGS[grid].replace(propagation = propagation_mode)
+    wavelen = config.wavelen
+    groups = 10
 
-    # fig = px.scatter(data, x = 'slits_dist', y = 'vis', title = 'Visibility', color = 'filter_width')
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy) # Drawn here, so that it is stored with the fields if they are saved
 
-    return ['Analysis number {}'.format(n_clicks + 1)]
+    filter_width_ext = [round(g * 2e5 * np.pi / wavelen, 2) for g in filter_width_ext]
+    filter_width_step = round(0.01 * 2e5 * np.pi / wavelen, 2)
+    slits_dist_step = 0.5
+    filter_widths = np.arange(filter_width_ext[0], filter_width_ext[1] + filter_width_step, filter_width_step)
+    slits_dists = np.arange(slits_dist_ext[0], slits_dist_ext[1] + slits_dist_step, slits_dist_step)
+
+    # Chain of generators: the fields are generated, (saved,) filtered, propagated and summed in batches, so only one batch is in memory at a time
+    fields = mod.generate_speckle_fields(field_num, config, generator_mode, seed, workers)
+    batches = mod.field_batches(fields)
+    if 'Save the fields' in save:
+        mod.detach_patterns('Patterns') # The runs of the ensemble being replaced are not updated with the new fields
+        batches = mod.save_fields(batches, 'Speckles', field_num, config, {
+            'generator_mode': generator_mode,
+            'seed': seed
+        })
+
+    for count, avg_intensity, pattern_groups in mod.stream_patterns(batches, config, filter_type, filter_widths, slits_dists, groups):
+        if 'Save the fields' in save: # The average intensity belongs to the stored fields, kept in step with them in case the pipeline is cancelled
+            with open('numbers.txt', 'w') as f:
+                f.write(str(avg_intensity))
+        set_progress((str(count), str(field_num)))
+
+    if 'Save the patterns' in save:
+        # The patterns are tied to the stored ensemble only if the fields are saved too (otherwise they are never updated with new fields)
+        mod.save_patterns('Patterns', 'stream_{}'.format(n_clicks), config, filter_type, filter_widths, slits_dists, pattern_groups, 
+                          {'field_num': field_num if 'Save the fields' in save else None, 'groups': groups}, 
+                          mod.ensemble_identity('Speckles') if 'Save the fields' in save else None)
+
+    results = mod.stream_analysis(config, pattern_groups, filter_type, filter_widths, slits_dists, avg_intensity, analysis_mode, error_mode)
+    save_correlation(results, len(pattern_groups), set_progress)
+
+    return ['Pipeline number {}'.format(n_clicks + 1)]
 
 @callback(
     # Callback for plotting the correlation functions
@@ -927,7 +1292,10 @@ def plot_all(n_clicks):
 
     corr_theo = pd.DataFrame(columns = cols, data = np.transpose(np.array(theo)))
 
-    fig_1 = px.scatter(corr_data, x = 'slits_dist', y = 'corr', title = 'Field correlation function', color = 'filter_width', labels = {
+    # Error bars, if the uncertainties were estimated in the analysis
+    error_y = 'corr_err' if 'corr_err' in corr_data and corr_data['corr_err'].notna().any() else None
+
+    fig_1 = px.scatter(corr_data, x = 'slits_dist', y = 'corr', error_y = error_y, title = 'Field correlation function', color = 'filter_width', labels = {
         'slits_dist': 'Slit separation [mm]',
         'corr': 'Correlation',
         'filter_width': 'Filter width'
@@ -957,8 +1325,7 @@ def plot_cvf(n_clicks):
     if n_clicks is None:
         raise exceptions.PreventUpdate()
     
-    wavelen = 500 # [nm]
-    dist_2 = 1e4 # [cm]
+    wavelen = mod.CONFIGS['Production'].wavelen # [nm] (the same for all the grids)
     
     corr_data = pd.read_csv('corr_data.csv')
     filter_width = corr_data['filter_width'].to_numpy()
@@ -994,4 +1361,5 @@ def plot_cvf(n_clicks):
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO) # Show the reports of the analysis (e.g. the cost of the envelope fits)
     app.run(debug=True)
\ No newline at end of file
@@ -1,17 +1,161 @@
 import numpy as np
 import pandas as pd
-from scipy.fft import fft, ifft, fftshift, ifftshift
+from scipy.fft import fft, ifft, fftshift, ifftshift, fftfreq, next_fast_len
 from scipy.optimize import curve_fit, minimize
+from scipy.signal import CZT
 import plotly.express as px
+from concurrent.futures import ProcessPoolExecutor
+import os
+import json
+from collections import OrderedDict, deque
+from itertools import islice
+from functools import lru_cache
+import logging
+
+logger = logging.getLogger(__name__)
+
+def fft_length(dim):
+    """ Length of the FFT used to filter fields of dim points: 6001 = 17 x 353 is a slow length for the FFT, so the fields are padded with zeros up to 
+    the next length with only small prime factors (6048 = 2^5 x 3^3 x 7, about four times faster)
+    Arguments:
+        dim: number of points of the fields
+    Returns:
+        n_fft: length of the FFT
+    """
+    return next_fast_len(dim)
+
+class SimulationConfig:
+    """ Grid of the screen and geometry of the set-up, shared by all the parts of the simulation. The arrays derived from them (screen, frequencies of 
+    the FFT, filter profiles and propagation kernels) are calculated only once for each configuration, so that the same code can run coarse sweeps 
+    for a quick preview and fine ones for production. A configuration is not meant to be changed once created.
+    """
+
+    def __init__(self, screen_size = 30, dx = 0.005, wavelen = 500, dist_2 = 1e4, slit_width = 0.2, source_size = 0.5, dist = 15, scatt_num = 1000, 
+                 propagation = 'Huygens sum'):
+        """
+        Arguments:
+            screen_size: size of the screen (section of the beam under analysis) in [cm]
+            dx: resolution of the screen in [cm]
+            wavelen: wavelength of the light in [nm]
+            dist_2: distance from the double slit to the screen on which interference is observed in [cm]
+            slit_width: width of either of the two slits in [mm]
+            source_size: size of the source line of the speckle fields in [cm]
+            dist: distance from the source line to the plane of the double slit in [cm]
+            scatt_num: number of scatterers in the source line
+            propagation: a string, either 'Huygens sum' or 'Fresnel FFT', determines how the fields are propagated from the double slit to the 
+                screen (see propagation_operator)
+        """
+        self.screen_size = float(screen_size)
+        self.dx = float(dx)
+        self.wavelen = float(wavelen)
+        self.dist_2 = float(dist_2)
+        self.slit_width = float(slit_width)
+        self.source_size = float(source_size)
+        self.dist = float(dist)
+        self.scatt_num = int(scatt_num)
+        self.propagation = propagation
+
+        self.dim = int(round(self.screen_size / self.dx)) + 1 # Dimension of the arrays
+        self.screen = np.linspace(-self.screen_size/2, self.screen_size/2, self.dim)
+        self.n_fft = fft_length(self.dim) # Length of the (zero padded) FFT of the fields
+        self.kspace = 2 * np.pi * fftfreq(self.n_fft, self.dx) # Angular frequencies of the FFT [1/cm] (unshifted order)
+        self.screen.flags.writeable = False
+        self.kspace.flags.writeable = False
+
+    def header(self):
+        """ Parameters of the configuration, as saved in the headers of the stores """
+        return {'screen_size': self.screen_size, 'dx': self.dx, 'wavelen': self.wavelen, 'dist_2': self.dist_2, 'slit_width': self.slit_width, 
+                'source_size': self.source_size, 'dist': self.dist, 'scatt_num': self.scatt_num, 'propagation': self.propagation}
+
+    def replace(self, **changes):
+        """ Copy of the configuration with some parameters changed (as keyword arguments, with the names of the arguments of the constructor) """
+        return SimulationConfig(**dict(self.header(), **changes))
+
+    @classmethod
+    def from_header(cls, header):
+        """ Configuration of the fields or of the patterns of a store
+        Arguments:
+            header: header of the store, as given by read_header
+        Returns:
+            config: the configuration saved in the header or, for the stores written before the configurations, the default geometry on the grid
+            of the store
+        """
+        if 'config' in header:
+            return cls(**header['config'])
+
+        start, stop, dim = header['screen']
+        params = {key: header[key] for key in ('wavelen', 'source_size', 'dist', 'scatt_num') if key in header} # Saved with the fields
+        return cls(screen_size = stop - start, dx = (stop - start) / (dim - 1), **params)
+
+    def __eq__(self, other):
+        return isinstance(other, SimulationConfig) and self.header() == other.header()
+
+    def __hash__(self):
+        return hash(tuple(self.header().items()))
+
+    def profile(self, filter_type, filter_width):
+        """ Profile of the spatial filter on the spectra of the fields (see filter_profile) """
+        return filter_profile(filter_type, float(filter_width), self.n_fft, self.dx)
+
+    def operator(self, slits_dist):
+        """ Propagation operator through a double slit with a given distance between the slits in [mm] (see propagation_operator) """
+        return propagation_operator(self.dist_2, slits_dist, self.slit_width, self.screen, self.wavelen, self.propagation)
+
+# Configurations offered by the interface: the preview has half the resolution (a quarter of the cost of the propagation and half of the filtering)
+CONFIGS = {'Production': SimulationConfig(), 'Preview': SimulationConfig(dx = 0.01)}
+
+def speckle_block_size(dim, mem_budget):
+    """ Calculate how many scatterers can be summed together as a block without exceeding a memory budget
+    Arguments:
+        dim: number of points on the screen
+        mem_budget: memory in [bytes] available for the temporary arrays of one block
+    Returns:
+        block: number of scatterers per block (at least 1)
+    """
+    # Each element of the block needs one float64 (distance and phase) and four float32 temporaries (amplitude, phase, cosine/sine, product)
+    return max(1, int(mem_budget // (dim * 24)))
+
+def spherical_wave_sum(scatt, phase_shift, screen, dist, wavelen, corr = 0):
+    """ Sum on the screen the spherical waves produced by a block of scatterers (Huygens principle)
+    Arguments:
+        scatt: numpy array with the positions of the scatterers in [cm]
+        phase_shift: numpy array with the random phases of the scatterers
+        screen: coordinates of the points on the screen in [cm]
+        dist: distance from the source line to the screen in [cm]
+        wavelen: wavelength of the light in [cm]
+        corr: inverse correlation length of the source in [1/cm] (0 for an uncorrelated source)
+    Returns:
+        field: numpy array containing the field produced by the block of scatterers on the screen
+    """
+
+    # Lengths are measured in wavelengths, so that the distance from each scatterer is directly the number of cycles of the phase
+    cycles = np.subtract.outer(scatt / wavelen, screen / wavelen) # (scatterers x screen) block
+    if corr != 0:
+        profile = np.exp(-(cycles * wavelen * corr) ** 2).astype(np.float32) # Gaussian profile of the wave from each scatterer (not tested yet)
+    np.square(cycles, out = cycles)
+    cycles += (dist / wavelen) ** 2
+    np.sqrt(cycles, out = cycles)
+
+    amp = np.reciprocal(cycles, dtype = np.float32) * np.float32(dist / wavelen) # Same as 1/sqrt(1 + (scatt - screen)^2/dist^2)
+    if corr != 0:
+        amp *= profile
 
-def generate_speckle_field(source_size, dist, scatt_num, wavelen): # Use, for the first field, a "monte carlo" method
+    cycles += (phase_shift / (2 * np.pi * wavelen))[:, None] # Random phase (same convention as the original sum, phase_shift/wavelen)
+    cycles -= np.rint(cycles) # Keep only the fractional part, so that the phase can be evaluated in single precision without losing accuracy
+    phase = cycles.astype(np.float32) * np.float32(2 * np.pi)
+
+    # Sum over the scatterers of the block as a matrix product
+    ones = np.ones(len(scatt), dtype = np.float32)
+    return (ones @ (amp * np.cos(phase))) + 1j * (ones @ (amp * np.sin(phase)))
+
+def generate_speckle_field(config, mem_budget = 2 ** 21, rng = None): # Use, for the first field, a "monte carlo" method
     """ Generate a numpy array containing a one-dimensional speckle field using a monte carlo randomization
     Arguments:
         corr: correlation length of the source in [um]
-        source_size: size of the source line in [cm]
-        dist: distance from the source of the field to the screen on which it appears in [cm]
-        scatt_num: number of source points in the source line
-        wavelen: wavelength of the light in [nm]
+        config: SimulationConfig with the screen and the source (size of the source line, its distance from the screen, number of scatterers and
+            wavelength)
+        mem_budget: memory in [bytes] for the block of scatterers summed at once (the default keeps the block in cache)
+        rng: numpy random generator used for the extraction (the global numpy random state if None)
     Returns:
         (field, screen): tuple of a numpy array containing the speckle field and a numpy array containing the coordinates of the points on the screen in [cm]
     """
@@ -19,73 +163,732 @@ def generate_speckle_field(source_size, dist, scatt_num, wavelen): # Use, for th
     # corr = corr / 1e4 # Convert lengths to cm
 
     corr = 0
-    wavelen = wavelen / 1e7
+    source_size, dist, scatt_num = config.source_size, config.dist, config.scatt_num
+    wavelen = config.wavelen / 1e7
 
-    screen_size = 30 # [cm] (section of the beam under analysis)
-    dx = 0.005 # [cm] (resolution)
-    dim = int(screen_size/dx) + 1 # Dimension of the arrays
+    if rng is None:
+        rng = np.random
+
+    dim = config.dim # Dimension of the arrays
     field = np.zeros(dim, dtype = complex) # Array containing the speckle field
-    screen = np.linspace(-screen_size/2, screen_size/2, dim)
-
-    if corr == 0:
-        # If there is no correlation length in the source, extract random points on the source area and add a spherical wave for each of them. The 
-        # resulting sum is the speckle field.
-        for i in range(scatt_num):
-            scatt = np.random.uniform(-source_size/2, source_size/2) # i-th scatterer position
-            phase_shift = np.random.uniform(-np.pi, np.pi) # Random phase
-            # Add the field produced by the source point (Huygens principle)
-            field += np.exp(1j * 2 * np.pi * np.sqrt(dist ** 2 + (scatt - screen) ** 2)/wavelen + 1j * phase_shift/wavelen)/np.sqrt(1 + (scatt - screen) ** 2/dist ** 2) 
-    else:
-        # If there is a nonzero correlation length, the wave from each scatterer is profiled by an Airy disc (or maybe a gaussian function is better). 
-        # The sum and the speckle field are calculated in the same way as above
-
-        for i in range(scatt_num):
-            scatt = np.random.uniform(-source_size/2, source_size/2) # i-th scatterer position
-            phase_shift = np.random.uniform(-np.pi, np.pi) # Random phase
-            # Add the field produced by the source point (Huygens principle) with gaussian profile. This has not been tested yet.
-            field += np.exp(1j * 2 * np.pi * np.sqrt(dist ** 2 + (scatt - screen) ** 2)/wavelen + 1j * phase_shift/wavelen) * np.exp(-((screen - scatt) * corr) ** 2)/np.sqrt(1 + (scatt - screen) ** 2 / dist ** 2)
+    screen = np.array(config.screen)
+
+    # Extract random points on the source area and add a spherical wave for each of them; the resulting sum is the speckle field. If there is a nonzero 
+    # correlation length, the wave from each scatterer is profiled by a gaussian function.
+    # All the scatterers are extracted at once, and their waves are summed in blocks whose size is chosen to fit the memory budget
+    scatt = rng.uniform(-source_size/2, source_size/2, scatt_num) # Scatterer positions
+    phase_shift = rng.uniform(-np.pi, np.pi, scatt_num) # Random phases
+    block = speckle_block_size(dim, mem_budget)
+
+    for i in range(0, scatt_num, block):
+        field += spherical_wave_sum(scatt[i:i + block], phase_shift[i:i + block], screen, dist, wavelen, corr)
     
     field = field/scatt_num
     # return the array with the field 
     return field, screen
 
-def filter(filter_type, field, filter_width):
+def generate_speckle_field_fft(config, rng = None):
+    """ Generate a numpy array containing a one-dimensional speckle field by filtering complex gaussian noise in the Fourier domain
+    Arguments:
+        config: SimulationConfig with the screen and the source (the number of scatterers only sets the normalization, as in generate_speckle_field)
+        rng: numpy random generator used for the noise (the global numpy random state if None)
+    Returns:
+        (field, screen): tuple of a numpy array containing the speckle field and a numpy array containing the coordinates of the points on the screen in [cm]
+    """
+
+    source_size, dist, scatt_num = config.source_size, config.dist, config.scatt_num
+    wavelen = config.wavelen / 1e7
+
+    if rng is None:
+        rng = np.random
+
+    dx = config.dx
+    dim = config.dim # Dimension of the arrays
+    screen = np.array(config.screen)
+
+    # A fully developed speckle field is a circular gaussian random field. Its angular spectrum is the one of the source seen from the screen, i.e. a 
+    # rectangle of width 2 pi source_size/(wavelen dist) (which may be wider than the band of the grid, in which case the field is white noise)
+    kspace = 2 * np.pi * fftfreq(dim, dx)
+    profile = np.abs(kspace) <= np.pi * source_size / (wavelen * dist)
+
+    transf = (rng.normal(size = dim) + 1j * rng.normal(size = dim)) * profile
+    field = ifft(transf) * dim / np.sqrt(2 * np.count_nonzero(profile)) # Unit average intensity
+
+    # The average intensity of the Huygens sum is not uniform on the screen, because of the obliquity factor of the spherical waves: average it over the source
+    envelope = dist / source_size * (np.arctan((screen + source_size/2) / dist) - np.arctan((screen - source_size/2) / dist))
+    field = field * np.sqrt(envelope / scatt_num)
+
+    return field, screen
+
+class AngularSpectrumOperator:
+    """ Propagation of the spherical waves of the scatterers from the source line to the screen through the angular spectrum of the source. The 
+    scatterers are deposited on a fine grid of the source line with a gaussian kernel (the gridding step of a nonuniform FFT), whose FFT gives the 
+    amplitudes of the plane waves leaving the source; each plane wave reaches the screen with the phase kz dist. The screen is split in segments: each 
+    one receives only the band of directions which joins it to the source, and its field is the inverse FFT of the band folded on a window around it.
+    The cost is O(N log N) in the points of the grids plus O(scatt_num) for the deposit, instead of O(scatt_num dim) for the direct sum.
+    The waves are the ones of spherical_wave_sum up to the stationary phase approximation of the angular spectrum (relative error ~ 1/(k dist)), the 
+    gridding and the tapers of the bands: the largest error of the wave of a single scatterer is measured on construction against the direct sum, and 
+    bounds the error of the fields, which are averages of waves of unit modulus.
+    """
+
+    def __init__(self, config, segment = 1, margin = 0.2, taper = 0.4, spread = 8, oversampling = 2, checks = 32):
+        """
+        Arguments:
+            config: SimulationConfig with the screen and the source
+            segment: length of the segments of the screen in [cm]
+            margin: distance in [cm] beyond the geometric shadow of the source on each segment over which its band of directions is kept whole 
+                (it must contain the neighbourhood of the stationary point)
+            taper: distance in [cm] over which the band is then brought to zero with a raised cosine
+            spread: half width of the gaussian kernel of the deposit in points of the source grid
+            oversampling: ratio between the band of the source grid and the highest direction used
+            checks: number of single scatterers (on the edges and at random positions of the source line) whose waves are compared with the direct sum
+        """
+
+        wavelen = config.wavelen / 1e7 # Convert lengths to cm
+        k = 2 * np.pi / wavelen
+        dist, half, dx, dim = config.dist, config.source_size / 2, config.dx, config.dim
+        screen = config.screen
+
+        seg = int(round(segment / dx)) # Points of each segment
+        starts = np.arange(0, dim, seg)
+        ends = np.minimum(starts + seg, dim) - 1
+
+        # Light of the band of a segment lands at most 2 half + margin + taper away from it: the window of the inverse FFT must hold it all, since what 
+        # falls outside is folded back. The directions are spaced so that the window is one period of the inverse FFT
+        reach = 2 * half + margin + taper
+        self.n_window = next_fast_len(seg + int(np.ceil(2 * reach / dx)))
+        dk = 2 * np.pi / (self.n_window * dx)
+        offset = (self.n_window - seg) // 2 # Position of the segment in its window
+
+        # Transverse wavenumber of the wave which lands x away from its scatterer. Each band is flat on the directions joining the segment to the whole 
+        # source, plus the margin, and goes to zero with a raised cosine over the taper
+        direction = lambda x: k * x / np.sqrt(dist ** 2 + x ** 2)
+        edges = direction(np.stack([screen[starts] - half - margin - taper, screen[starts] - half - margin, screen[ends] + half + margin, 
+                                    screen[ends] + half + margin + taper], axis = 1))
+
+        # Bands start on multiples of the window and have all the same length, so that they are folded on their windows with a reshape
+        low = np.floor(edges[:, 0] / (dk * self.n_window)).astype(int) * self.n_window
+        length = np.max(np.ceil(edges[:, 3] / (dk * self.n_window)).astype(int) * self.n_window - low)
+        index = low[:, None] + np.arange(length) # Directions kappa = index dk of the band of each segment
+        kappa = index * dk
+        rise = np.clip((kappa - edges[:, [0]]) / (edges[:, [1]] - edges[:, [0]]), 0, 1)
+        fall = np.clip((edges[:, [3]] - kappa) / (edges[:, [3]] - edges[:, [2]]), 0, 1)
+        window = (1 - np.cos(np.pi * np.minimum(rise, fall))) / 2
+
+        # Grid of the source line, with the same period as the windows (so that its FFT is sampled at the directions kappa) and fine enough to sample 
+        # the highest direction with the given oversampling. Gaussian kernel of the deposit as in Greengard and Lee (SIAM Review 46, 2004)
+        self.n_grid = next_fast_len(int(np.ceil(self.n_window * dx * oversampling * np.max(np.abs(kappa)) / np.pi)))
+        self.h = self.n_window * dx / self.n_grid
+        self.origin = -self.n_window * dx / 2
+        self.spread = spread
+        self.tau = spread * oversampling * self.h ** 2 / (4 * np.pi * (oversampling - 0.5))
+        self.index = index % self.n_grid
+
+        # Amplitude of each plane wave such that the stationary phase of the band gives back the wave dist/R exp(ikR) of each scatterer, corrected for 
+        # the gaussian kernel and for the origins of the source grid and of the windows (zero outside the bands)
+        kz = np.sqrt(k ** 2 - kappa ** 2)
+        corners = screen[starts] - offset * dx
+        self.kernel = (window * dk * np.sqrt(dist / (2 * np.pi * kz)) * np.exp(1j * (kz * dist + np.pi/4 + kappa * (corners[:, None] - self.origin)))
+                       * self.h / (np.sqrt(4 * np.pi * self.tau) * np.exp(-self.tau * kappa ** 2)))
+
+        points = np.arange(dim)
+        self.output = (points // seg) * self.n_window + offset + points % seg # Position of each point of the screen in the windows
+
+        # Accuracy check: largest error of the wave of a single scatterer (unit amplitude) against the direct sum, over the whole screen
+        rng = np.random.default_rng(0)
+        sources = np.concatenate(([-half, half], rng.uniform(-half, half, checks - 2)))
+        self.error = max(np.max(np.abs(self.propagate(np.array([s]), np.ones(1, dtype = complex)) 
+                                       - spherical_wave_sum(np.array([s]), np.zeros(1), screen, dist, wavelen))) for s in sources)
+
+    def propagate(self, scatt, amplitudes):
+        """ Sum on the screen the waves of a set of scatterers
+        Arguments:
+            scatt: numpy array with the positions of the scatterers in [cm]
+            amplitudes: numpy array with the complex amplitudes of the scatterers
+        Returns:
+            field: numpy array containing the field produced by the scatterers on the screen
+        """
+
+        # Deposit each scatterer on the nearest points of the source grid, weighted by the gaussian kernel
+        points = np.rint((scatt - self.origin) / self.h).astype(int)[:, None] + np.arange(-self.spread, self.spread + 1)
+        weights = (amplitudes[:, None] * np.exp(-(self.origin + points * self.h - scatt[:, None]) ** 2 / (4 * self.tau))).ravel()
+        grid = np.bincount(points.ravel(), weights.real, self.n_grid) + 1j * np.bincount(points.ravel(), weights.imag, self.n_grid)
+
+        # Plane waves of each band reaching the screen, folded on the window of their segment
+        bands = self.kernel * fft(grid)[self.index]
+        windows = ifft(bands.reshape(len(bands), -1, self.n_window).sum(axis = 1), axis = -1, norm = 'forward')
+        return windows.ravel()[self.output]
+
+@lru_cache(maxsize = 4)
+def angular_spectrum_operator(config):
+    """ Build the angular spectrum operator of a configuration once per process (see AngularSpectrumOperator) """
+    return AngularSpectrumOperator(config)
+
+def generate_speckle_field_angular(config, rng = None, tolerance = 1e-4):
+    """ Generate a numpy array containing a one-dimensional speckle field with the same scatterers as generate_speckle_field (the same draws from the 
+    random generator), whose waves are summed through the angular spectrum of the source (see AngularSpectrumOperator)
+    Arguments:
+        config: SimulationConfig with the screen and the source
+        rng: numpy random generator used for the extraction (the global numpy random state if None)
+        tolerance: largest error of the waves of the scatterers allowed: beyond it the direct sum is used
+    Returns:
+        (field, screen): tuple of a numpy array containing the speckle field and a numpy array containing the coordinates of the points on the screen in [cm]
+    """
+
+    operator = angular_spectrum_operator(config)
+    if operator.error > tolerance:
+        return generate_speckle_field(config, rng = rng)
+
+    source_size, scatt_num = config.source_size, config.scatt_num
+    wavelen = config.wavelen / 1e7
+
+    if rng is None:
+        rng = np.random
+
+    scatt = rng.uniform(-source_size/2, source_size/2, scatt_num) # Scatterer positions
+    phase_shift = rng.uniform(-np.pi, np.pi, scatt_num) # Random phases (same convention as spherical_wave_sum, phase_shift/wavelen)
+    field = operator.propagate(scatt, np.exp(1j * phase_shift / wavelen)) / scatt_num
+
+    return field, np.array(config.screen)
+
+def speckle_task(task):
+    """ Generate one speckle field with its own random stream (this function is executed by the worker processes of generate_speckle_fields)
+    Arguments:
+        task: tuple (seed, generator_mode, config), where seed is the numpy SeedSequence of the field and config the SimulationConfig
+    Returns:
+        (field, screen): tuple of a numpy array containing the speckle field and a numpy array containing the coordinates of the points on the screen in [cm]
+    """
+
+    seed, generator_mode, config = task
+    rng = np.random.default_rng(seed)
+
+    if generator_mode == 'FFT synthesis':
+        return generate_speckle_field_fft(config, rng = rng)
+    elif generator_mode == 'Angular spectrum':
+        return generate_speckle_field_angular(config, rng = rng)
+    else:
+        return generate_speckle_field(config, rng = rng)
+
+def generate_speckle_fields(field_num, config, generator_mode = 'Huygens sum', seed = None, workers = 1, first = 0):
+    """ Generate an ensemble of speckle fields on a pool of processes. Each field has an independent random stream spawned from a single master seed, so 
+    the ensemble does not depend on the number of workers
+    Arguments:
+        field_num: number of fields to generate
+        config: SimulationConfig with the screen and the source
+        generator_mode: a string, either 'Huygens sum', 'FFT synthesis' or 'Angular spectrum', determines the generator used
+        seed: master seed of the ensemble (a random one is drawn from the system if None)
+        workers: number of worker processes (1 to generate the fields in the calling process)
+        first: number of fields of the ensemble already generated with the same seed: the new fields continue the ensemble (so that generating N fields
+            and then K more gives the same N + K fields as generating them all at once)
+    Returns:
+        fields: generator yielding a tuple (field, screen) for each field, in order
+    """
+
+    seeds = np.random.SeedSequence(seed, n_children_spawned = first).spawn(field_num) # One child stream per field, after the first ones
+    tasks = ((s, generator_mode, config) for s in seeds)
+
+    if workers == 1:
+        for task in tasks:
+            yield speckle_task(task)
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            # Only a few fields per process are submitted ahead of the one being yielded (as in analyze_patterns), so that the fields do not pile up 
+            # in memory when they are consumed more slowly than they are generated
+            pending = deque(executor.submit(speckle_task, task) for task in islice(tasks, 2 * workers))
+            try:
+                while pending:
+                    field = pending.popleft().result()
+                    for task in islice(tasks, 1): # One new field for each one collected
+                        pending.append(executor.submit(speckle_task, task))
+                    yield field
+            finally:
+                for future in pending: # Only reached before the end if the generator is closed early
+                    future.cancel()
+
+def speckle_statistics(fields, screen, max_lag = 1):
+    """ Calculate the intensity statistics and the correlation width of an ensemble of speckle fields
+    Arguments:
+        fields: numpy array with one speckle field per row
+        screen: coordinates of the points on the screen in [cm]
+        max_lag: largest separation between two points of the screen for which the degree of coherence is calculated in [cm]
+    Returns:
+        (avg_intensity, contrast, corr_width, coh_length): average intensity, contrast (standard deviation over mean of the intensity, 1 for fully developed 
+        speckle), FWHM of the modulus of the degree of coherence and coherence length (integral of its square modulus) in [cm]
+    """
+
+    dx = screen[1] - screen[0]
+
+    intensity = np.abs(fields) ** 2
+    avg_profile = np.mean(intensity, axis = 0) # Average intensity on each point of the screen
+    contrast = np.mean(np.std(intensity, axis = 0) / avg_profile)
+
+    # Modulus of the degree of coherence between x and x + lag (ensemble average), averaged over x
+    norm_fields = fields / np.sqrt(avg_profile)
+    lags = np.arange(int(round(max_lag / dx)) + 1)
+    mu = np.zeros(len(lags))
+    for l in lags:
+        mu[l] = np.mean(np.abs(np.mean(norm_fields[:, :fields.shape[1] - l] * np.conj(norm_fields[:, l:]), axis = 0)))
+    mu = mu / mu[0]
+
+    # Mirror the lags to have a peaked function
+    lag = np.concatenate((-lags[:0:-1], lags)) * dx
+    mu = np.concatenate((mu[:0:-1], mu))
+
+    return np.mean(avg_profile), contrast, FWHM(mu, lag), np.sum(mu ** 2) * dx
+
+def validate_fft_generator(config, field_num = 50, grain_points = 6, screen_size = 1):
+    """ Compare the statistics of the speckle fields generated with the Huygens sum and with the FFT synthesis, in the paraxial part of the screen
+    Arguments:
+        config: SimulationConfig with the screen and the source
+        field_num: number of fields generated with each method
+        grain_points: number of points of the screen per speckle grain in the comparison
+        screen_size: size of the screen of the comparison, centered on the axis, in [cm]
+    Returns:
+        stats: pandas dataframe with the average intensity, the contrast, the correlation width and the coherence length obtained with each method
+    """
+
+    # The speckle grain (wavelen dist/source_size) is usually smaller than the resolution of the simulation, where both generators give white noise
+    # and the correlation widths are trivially zero: compare them on a finer grid, which resolves the grain, around the axis
+    grain = config.wavelen / 1e7 * config.dist / config.source_size
+    config = config.replace(screen_size = screen_size, dx = grain / grain_points)
+
+    rows = []
+    # The FFT synthesis is stationary, while the width of the spectrum of the Huygens sum grows with the obliquity: compare them in the paraxial region
+    cut = config.dist / 5
+
+    for method, generator in [('Huygens sum', generate_speckle_field), ('FFT synthesis', generate_speckle_field_fft)]:
+        fields = []
+        for i in range(field_num):
+            field, screen = generator(config)
+            fields.append(field)
+        paraxial = np.abs(screen) <= cut
+        rows.append([method, *speckle_statistics(np.array(fields)[:, paraxial], screen[paraxial], max_lag = 10 * grain)])
+        if rows[-1][3] < 2 * config.dx:
+            raise ValueError('The correlation width of the {} is not resolved on the grid of the comparison'.format(method))
+
+    return pd.DataFrame(rows, columns = ['method', 'avg_intensity', 'contrast', 'corr_width', 'coh_length'])
+
+@lru_cache(maxsize = 256)
+def filter_profile(filter_type, filter_width, n_fft, dx):
+    """ Calculate the profile by which the spectrum of a field is multiplied in the spatial filtering. The profiles are memoized, since the same ones are 
+    used for every field of the ensemble
+    Arguments:
+        filter_type: a string, either 'Gaussian' or 'Rectangular', determines the type of filtering
+        filter_width: width of the spectrum resulting from the filtering
+        n_fft: length of the (zero padded) FFT of the fields, see fft_length
+        dx: resolution of the screen in [cm]
+    Returns:
+        profile: numpy array with the profile, in the order of the frequencies of the (unshifted) FFT (read only, as it is shared)
+    """
+
+    kspace = 2 * np.pi * fftfreq(n_fft, dx) # Frequencies of the padded FFT, already in the FFT order so that the spectra do not need to be shifted
+
+    if filter_type == 'Rectangular':
+        profile = (abs(kspace) <= filter_width/2).astype(float) # Step function
+    else:
+        profile = np.exp(-(kspace / filter_width) ** 2 / 2) # Gaussian function
+
+    profile.flags.writeable = False
+    return profile
+
+def field_spectra(fields, workers = -1):
+    """ Calculate the spectra of a stack of fields with a single batched FFT, padding the fields with zeros up to fft_length
+    Arguments:
+        fields: numpy array with one field per row (or a single field)
+        workers: number of threads used by the FFT (-1 for all the cpus)
+    Returns:
+        transf: numpy array with the spectrum of each field (unshifted FFT order), of length fft_length(dim)
+    """
+    return fft(fields, fft_length(fields.shape[-1]), axis = -1, workers = workers)
+
+def filter_spectra(filter_type, transf, filter_width, config, workers = -1):
+    """ Execute spatial filtering on fields whose spectra have already been calculated, for one or several filter widths
+    Arguments: 
+        filter_type: a string, either 'Gaussian' or 'Rectangular', determines the type of filtering
+        transf: numpy array with the spectra of the fields (unshifted FFT order, one per row), as given by field_spectra
+        filter_width: width of the spectrum resulting from the filtering, or list of widths
+        config: SimulationConfig of the fields (the filtered fields are cropped to its screen, the rest is padding)
+        workers: number of threads used by the inverse FFT (-1 for all the cpus)
+    Returns:
+        filt_fields: numpy array containing the filtered fields (with a first axis running over the filter widths if a list is given)
+    """
+
+    # Profile the spectrum with the appropriate function (step or gaussian) and then IFFT
+    if np.ndim(filter_width) == 0:
+        profile = config.profile(filter_type, filter_width)
+    else:
+        profile = np.array([config.profile(filter_type, w) for w in filter_width])
+        profile = profile.reshape(profile.shape[:1] + (1,) * (transf.ndim - 1) + profile.shape[1:]) # Broadcast the widths over the fields
+
+    return ifft(transf * profile, axis = -1, workers = workers)[..., :config.dim]
+
+def filter_batch(filter_type, fields, filter_widths, config, workers = -1):
+    """ Execute spatial filtering on a stack of fields for several filter widths, with one stacked FFT and one stacked inverse FFT
+    Arguments: 
+        filter_type: a string, either 'Gaussian' or 'Rectangular', determines the type of filtering
+        fields: numpy array with one field per row (fields x screen)
+        filter_widths: list of widths of the spectrum resulting from the filtering
+        config: SimulationConfig of the fields
+        workers: number of threads used by the FFTs (-1 for all the cpus)
+    Returns:
+        filt_fields: numpy array containing the filtered fields (filter widths x fields x screen)
+    """
+    return filter_spectra(filter_type, field_spectra(fields, workers), filter_widths, config, workers)
+
+def filter(filter_type, field, filter_width, config):
     """ Execute spatial filtering on a 1D speckle field using fast fourier transform
     Arguments: 
         filter_type: a string, either 'Gaussian' or 'Rectangular', determines the type of filtering
         field: numpy array containing the speckle field to be filtered
         filter_width: width of the spectrum resulting from the filtering
+        config: SimulationConfig of the field
     Returns:
         filt_field: numpy array containing the filtered field
     """
 
-    screen_size = 30 # [cm] (section of the beam under analysis)
-    dx = 0.005 # [cm] (resolution)
-        
-    kspace_size = 2 * np.pi/dx
-    dk = 2 * np.pi/screen_size
-    dim = int(kspace_size/dk) + 1 # Dimension of the arrays
-    kspace = np.linspace(-kspace_size / 2, kspace_size / 2, dim)
-
     # This functions just performs a FFT, profiles the spectrum with the appropriate function (step or gaussian) and then IFFTs.
-    if filter_type == 'Rectangular':
-        # Do what explained above
+    return filter_spectra(filter_type, field_spectra(field), filter_width, config)
 
-        transf = fftshift(fft(field))
-        transf[abs(kspace) > filter_width/2] = 0
+class SpectrumCache:
+    """ Cache of the spectra of the fields of an ensemble. The spectra are calculated only once, with batched FFTs, and they are reused for every filter 
+    width. If a path is given they are also saved in a binary store, so that they can be reused by later runs on the same ensemble; the blocks of spectra 
+    in use are kept in memory up to max_bytes, evicting the least recently used ones.
+    """
 
-        filt_field = ifft(ifftshift(transf))
-    else:
-        # Do what explained above
-        profile = np.exp(-(kspace / filter_width) ** 2 / 2)
-        transf = fftshift(fft(field))
-        transf = transf * profile
+    def __init__(self, fields, key = None, path = None, max_bytes = 2 ** 28):
+        """
+        Arguments:
+            fields: numpy array with one field per row (it can be memory mapped)
+            key: identifier of the ensemble (e.g. as given by ensemble_key), saved with the spectra to check that they belong to the ensemble
+            path: path of the binary store of the spectra, without extension (None to keep them in memory only)
+            max_bytes: memory in [bytes] available for the blocks of spectra
+        """
+        self.fields = fields
+        self.key = key
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict() # Blocks in memory, from the least to the most recently used
+        self.size = 0 # Memory used by the blocks in memory
+        shape = (len(fields), fft_length(fields.shape[1])) # The spectra are zero padded
+        self.block_size = max(1, int(max_bytes // (8 * shape[1] * 16))) # Rows per block: at least 8 blocks fit in memory
+        self.spectra = None
+
+        if path is not None:
+            if os.path.exists(path + '.json') and read_header(path).get('ensemble') == key and read_header(path)['shape'] == list(shape):
+                self.spectra = open_store(path)[0] # Spectra calculated by a previous run
+            else:
+                spectra, header = create_store(path, shape, np.complex128, {'ensemble': None})
+                for start in range(0, len(fields), self.block_size):
+                    spectra[start:start + self.block_size] = field_spectra(fields[start:start + self.block_size])
+                spectra.flush()
+                header['ensemble'] = key # Written only once all the spectra are there
+                write_header(path, header)
+                self.spectra = spectra
+
+    def block(self, start):
+        """ Spectra of the block of fields starting at a given row
+        Arguments:
+            start: first row of the block (a multiple of block_size)
+        Returns:
+            transf: numpy array with the spectra of the fields of the block
+        """
+        if start in self.blocks:
+            self.blocks.move_to_end(start)
+            return self.blocks[start]
+
+        stop = start + self.block_size
+        if self.spectra is not None:
+            transf = np.array(self.spectra[start:stop])
+        else:
+            transf = field_spectra(self.fields[start:stop])
+
+        self.blocks[start] = transf
+        self.size += transf.nbytes
+        while self.size > self.max_bytes and len(self.blocks) > 1: # Evict the least recently used blocks
+            self.size -= self.blocks.popitem(last = False)[1].nbytes
+
+        return transf
+
+    def __iter__(self):
+        """ Iterate over the blocks of spectra of the whole ensemble, in order """
+        for start in range(0, len(self.fields), self.block_size):
+            yield self.block(start)
+
+spectrum_caches = {} # Caches of the spectra in use, one per folder of fields
+
+def spectrum_cache(folder, max_bytes = 2 ** 28):
+    """ Get the cache of the spectra of the speckle ensemble stored in a folder, creating it if the ensemble has changed
+    Arguments:
+        folder: path of the folder containing the speckle fields
+        max_bytes: memory in [bytes] available for the blocks of spectra
+    Returns:
+        cache: SpectrumCache of the ensemble
+    """
+    fields, screen = open_speckles(folder)
+    key = ensemble_key(folder)
+
+    if folder not in spectrum_caches or spectrum_caches[folder].key != key or key is None:
+        path = os.path.join(folder, 'spectra') if key is not None else None # Spectra of csv fields are kept in memory only
+        spectrum_caches[folder] = SpectrumCache(fields, key, path, max_bytes)
+
+    return spectrum_caches[folder]
+
+def slit_points(screen, slits_dist, slit_width):
+    """ Find the points of the plane of the double slit which pass through the slits
+    Arguments:
+        screen: coordinates of the points on the screen in [cm]
+        slits_dist: distance between the two slits in [cm]
+        slit_width: width of either of the two slits in [cm]
+    Returns:
+        slit_index: numpy array with the indices of the points of the two slits
+    """
+    # Margin for the rounding of the coordinates, so that the points on the edges are kept and the two slits have the same number of points
+    slit_1 = np.abs(screen + slits_dist/2) <= slit_width/2 + 1e-9
+    slit_2 = np.abs(screen - slits_dist/2) <= slit_width/2 + 1e-9
+    return np.arange(len(screen))[np.logical_or(slit_1, slit_2)]
+
+def spherical_kernel(screen, sources, dist_2, wavelen):
+    """ Spherical waves from points of the plane of the double slit to points of the screen (Huygens principle)
+    Arguments:
+        screen: coordinates of the points on the screen in [cm]
+        sources: coordinates of the points of the double slit in [cm]
+        dist_2: distance from the double slit and the screen in [cm]
+        wavelen: wavelength of the light in [cm]
+    Returns:
+        kernel: numpy array (screen x sources) with the wave of each source on each point of the screen
+    """
+    delta = screen[:, None] - sources[None, :]
+    return np.exp(1j * 2 * np.pi * np.sqrt(dist_2 ** 2 + delta ** 2)/wavelen)/np.sqrt(1 + delta ** 2 / dist_2 ** 2)
+
+class PropagationOperator:
+    """ Propagation of a field from the double slit to the screen on which interference is observed (Huygens principle). The kernel of the propagation 
+    only depends on the geometry of the set-up, so it is calculated once and applied to the whole ensemble of fields with a matrix product.
+    """
+
+    def __init__(self, dist_2, slits_dist, slit_width, screen, wavelen):
+        """
+        Arguments:
+            dist_2: distance from the double slit and the screen on which interference is observed in [cm]
+            slits_dist: distance between the two slits in [mm]
+            slit_width: width of either of the two slits in [mm]
+            screen: coordinates of the points on the screen in [cm]
+            wavelen: wavelength of the light in [nm]
+        """
+
+        self.slit_index = slit_points(screen, slits_dist / 10, slit_width / 10) # Points of the field which pass through the slits (lengths in cm)
+
+        # Spherical wave from each point of the slits to each point of the screen (screen x slit points)
+        self.kernel = spherical_kernel(screen, screen[self.slit_index], dist_2, wavelen / 1e7)
+
+    def propagate(self, fields):
+        """ Propagate fields through the double slit to the screen
+        Arguments:
+            fields: numpy array with the field on the plane of the double slit (one per row, or a single field)
+        Returns:
+            numpy array with the field on the screen (one per row)
+        """
+        return fields[..., self.slit_index] @ self.kernel.T
+
+    def patterns(self, fields):
+        """ Calculate the interference patterns of fields
+        Arguments:
+            fields: numpy array with the field on the plane of the double slit (one per row, or a single field)
+        Returns:
+            numpy array with the interference pattern of each field
+        """
+        return np.abs(self.propagate(fields)) ** 2
+
+    def coherence(self, fields):
+        """ Calculate the (unnormalized) mutual coherence matrix of fields sampled at the points of the slits, summed over the fields
+        Arguments:
+            fields: numpy array with the field on the plane of the double slit (one per row)
+        Returns:
+            coherence: numpy array C with C[i, j] = sum over the fields of field[i] * conj(field[j]), for i, j points of the slits
+        """
+        slit_fields = fields[..., self.slit_index]
+        return slit_fields.T @ slit_fields.conj()
+
+    def coherence_pattern(self, coherence):
+        """ Calculate the sum of the interference patterns of an ensemble of fields from their mutual coherence matrix, as the diagonal of K C K^H 
+        (K is the kernel). The cost does not depend on the number of fields
+        Arguments:
+            coherence: mutual coherence matrix of the fields at the points of the slits, as given by coherence
+        Returns:
+            pattern: numpy array with the sum of the interference patterns of the fields
+        """
+        return np.sum((self.kernel @ coherence) * self.kernel.conj(), axis = 1).real
+
+    def csd_pattern(self, csd, region):
+        """ Calculate the sum of the interference patterns of an ensemble of fields from their cross-spectral density over a region which contains the 
+        slits: the mutual coherence matrix at the slits is just a block of it
+        Arguments:
+            csd: cross-spectral density of the fields over the region, as given by cross_spectral_density
+            region: indices of the points of the region (contiguous and containing the slits), as given by aperture_region
+        Returns:
+            pattern: numpy array with the sum of the interference patterns of the fields
+        """
+        pos = self.slit_index - region[0] # Position of the points of the slits in the region
+        return self.coherence_pattern(csd[np.ix_(pos, pos)])
+
+class FresnelOperator(PropagationOperator):
+    """ Propagation of a field from the double slit to the screen in the Fresnel approximation, as a chirp-z transform (an FFT with an arbitrary 
+    spacing of the frequencies) of the field over the span of the slits. The cost is O(N log N) per field whatever the width of the slits, while the 
+    kernel of PropagationOperator has one column per point of the slits: it pays off for wide slits or fine grids.
+    The distance of each point x of the screen from a point xi of the slits is expanded as R(x) - x xi / dist_2 + xi^2 / (2 dist_2), with R(x) the 
+    exact distance from the center of the slits: the first neglected term is of order x^3 xi / dist_2^3. The error is measured on construction against 
+    the direct sum, on a few points of the screen.
+    """
+
+    def __init__(self, dist_2, slits_dist, slit_width, screen, wavelen, checks = 64):
+        """
+        Arguments:
+            dist_2: distance from the double slit and the screen on which interference is observed in [cm]
+            slits_dist: distance between the two slits in [mm]
+            slit_width: width of either of the two slits in [mm]
+            screen: coordinates of the points on the screen in [cm] (equally spaced)
+            wavelen: wavelength of the light in [nm]
+            checks: number of points of the screen on which the field is compared with the direct sum
+        """
+
+        wavelen = wavelen / 1e7 # Convert lengths to cm
+        k = 2 * np.pi / wavelen
+        dx = screen[1] - screen[0]
+
+        self.slit_index = slit_points(screen, slits_dist / 10, slit_width / 10)
+        self.start = self.slit_index[0] # The transform runs over the span of the slits, with zeros between them
+        span = screen[self.start:self.slit_index[-1] + 1]
+
+        # sum over xi of field(xi) exp(-i k x xi / dist_2) on the grids x = x_0 + m dx and xi = xi_0 + n dx is a chirp-z transform with ratio 
+        # exp(-i k dx^2 / dist_2), once the field is multiplied by exp(-i k x_0 xi / dist_2) and the result by exp(-i k m dx xi_0 / dist_2)
+        self.czt = CZT(len(span), len(screen), w = np.exp(-1j * k * dx ** 2 / dist_2))
+        self.pre = np.exp(1j * k * span ** 2 / (2 * dist_2) - 1j * k * screen[0] * span / dist_2)
+        self.post = (np.exp(1j * k * np.sqrt(dist_2 ** 2 + screen ** 2) - 1j * k * (screen - screen[0]) * span[0] / dist_2) 
+                     / np.sqrt(1 + screen ** 2 / dist_2 ** 2))
+
+        # Accuracy check: field of a random field on the slits, compared with the direct sum on a subset of the screen
+        sample = np.unique(np.linspace(0, len(screen) - 1, checks).astype(int))
+        rng = np.random.default_rng(0)
+        test = rng.normal(size = len(self.slit_index)) + 1j * rng.normal(size = len(self.slit_index))
+        exact = spherical_kernel(screen[sample], screen[self.slit_index], dist_2, wavelen) @ test
+        self.error = np.max(np.abs(self.propagate_slits(test)[sample] - exact)) / np.max(np.abs(exact)) # Relative to the largest field
+
+    def propagate_slits(self, values):
+        """ Propagate fields given on the points of the slits only
+        Arguments:
+            values: numpy array with the field on the points of the slits, slit_index (one per row, or a single field)
+        Returns:
+            numpy array with the field on the screen (one per row)
+        """
+        span = np.zeros(values.shape[:-1] + (len(self.pre),), dtype = complex)
+        span[..., self.slit_index - self.start] = values
+        return self.czt(span * self.pre) * self.post
+
+    def propagate(self, fields):
+        """ Propagate fields through the double slit to the screen
+        Arguments:
+            fields: numpy array with the field on the plane of the double slit (one per row, or a single field)
+        Returns:
+            numpy array with the field on the screen (one per row)
+        """
+        return self.propagate_slits(fields[..., self.slit_index])
+
+    def coherence_pattern(self, coherence):
+        """ Calculate the sum of the interference patterns of an ensemble of fields from their mutual coherence matrix: the matrix is decomposed in 
+        coherent modes (its eigenvectors), whose patterns are summed with the eigenvalues as weights, so the cost does not depend on the number of fields
+        Arguments:
+            coherence: mutual coherence matrix of the fields at the points of the slits, as given by coherence
+        Returns:
+            pattern: numpy array with the sum of the interference patterns of the fields
+        """
+        eigval, eigvec = np.linalg.eigh(coherence)
+        modes = (eigvec * np.sqrt(np.clip(eigval, 0, None))).T # One mode per row (the matrix is positive semidefinite, up to rounding)
+        return np.sum(np.abs(self.propagate_slits(modes)) ** 2, axis = 0)
+
+def aperture_region(screen, slits_dist, slit_width):
+    """ Find the region of the plane of the double slit occupied by the slits, for the widest slit separation of a sweep
+    Arguments:
+        screen: coordinates of the points on the screen in [cm]
+        slits_dist: largest distance between the two slits in [mm]
+        slit_width: width of either of the two slits in [mm]
+    Returns:
+        region: numpy array with the (contiguous) indices of the points of the region
+    """
+    half_width = slits_dist / 20 + slit_width / 20 # Convert lengths to cm
+    return np.arange(len(screen))[np.abs(screen) <= half_width + 1e-9] # Margin for the rounding of the coordinates
+
+def cross_spectral_density(fields, region):
+    """ Calculate the (unnormalized) cross-spectral density J(x1, x2) of fields over a region, summed over the fields
+    Arguments:
+        fields: numpy array with one field per row
+        region: indices of the points of the region, as given by aperture_region
+    Returns:
+        csd: numpy array J with J[i, j] = sum over the fields of field[region[i]] * conj(field[region[j]])
+    """
+    region_fields = fields[..., region]
+    return region_fields.T @ region_fields.conj()
+
+def welford_update(count, mean, m2, block):
+    """ Add a block of samples to the streaming mean and sum of square deviations of a quantity (Welford algorithm, merging the statistics of the 
+    block as a whole), without keeping the samples
+    Arguments:
+        count: number of samples added so far
+        mean: numpy array with the mean of the samples added so far
+        m2: numpy array with the sum of the square deviations from the mean of the samples added so far (the variance is m2/(count - 1))
+        block: numpy array with one new sample per row
+    Returns:
+        (count, mean, m2): tuple with the updated statistics
+    """
+    num = len(block)
+    if num == 0:
+        return count, mean, m2
+
+    block_mean = np.mean(block, axis = 0)
+    block_m2 = np.sum((block - block_mean) ** 2, axis = 0)
+    delta = block_mean - mean
+    total = count + num
+
+    return total, mean + delta * num / total, m2 + block_m2 + delta ** 2 * count * num / total
+
+def group_matrix(first, num, groups):
+    """ Assign fields to groups in turn (field i of the ensemble to group i % groups), for the partial sums used to estimate the uncertainties
+    Arguments:
+        first: index in the ensemble of the first field
+        num: number of fields
+        groups: number of groups
+    Returns:
+        numpy array (groups x num) with 1 where the field belongs to the group, so that the product with one quantity per field (one per row) gives
+        the partial sums of the groups
+    """
+    return (np.arange(first, first + num) % groups == np.arange(groups)[:, None]).astype(float)
+
+@lru_cache(maxsize = 64)
+def cached_propagation_operator(dist_2, slits_dist, slit_width, screen_key, wavelen, mode, tolerance):
+    """ Build the propagation operator of a geometry, keeping the most recently used ones in memory (see propagation_operator) """
+    screen = np.linspace(*screen_key)
 
-        filt_field = ifft(ifftshift(transf))
+    if mode == 'Fresnel FFT':
+        operator = FresnelOperator(dist_2, slits_dist, slit_width, screen, wavelen)
+        if operator.error <= tolerance:
+            return operator
 
-    return filt_field
+    return PropagationOperator(dist_2, slits_dist, slit_width, screen, wavelen)
+
+def propagation_operator(dist_2, slits_dist, slit_width, screen, wavelen, mode = 'Huygens sum', tolerance = 1e-3):
+    """ Get the propagation operator of a geometry, which is built only the first time it is needed
+    Arguments:
+        dist_2: distance from the double slit and the screen on which interference is observed in [cm]
+        slits_dist: distance between the two slits in [mm]
+        slit_width: width of either of the two slits in [mm]
+        screen: coordinates of the points on the screen in [cm] (equally spaced)
+        wavelen: wavelength of the light in [nm]
+        mode: a string, either 'Huygens sum' (direct sum of the spherical waves, PropagationOperator) or 'Fresnel FFT' (chirp-z transform, 
+            FresnelOperator)
+        tolerance: largest relative error of the field allowed for the Fresnel FFT: beyond it the direct sum is used
+    Returns:
+        operator: PropagationOperator (or FresnelOperator) of the geometry
+    """
+    return cached_propagation_operator(float(dist_2), float(slits_dist), float(slit_width), tuple(screen_header(screen)), float(wavelen), mode, tolerance)
 
-def create_pattern(field, dist_2, slits_dist, slit_width, screen, wavelen):
+def create_pattern(field, dist_2, slits_dist, slit_width, screen, wavelen, mode = 'Huygens sum'):
     """ This function profiles the filtered speckle field with a double slit and then propagates it on the final screen, creating the interference pattern to analyze
     Arguments:
         field: filtered speckle field on the plane where lies the doble slit
@@ -94,37 +897,68 @@ def create_pattern(field, dist_2, slits_dist, slit_width, screen, wavelen):
         slit_width: width of either of the two slits in [mm]
         screen: coordinates of the points on the screen in [cm]
         wavelen: wavelength of the light in [nm]
+        mode: a string, either 'Huygens sum' or 'Fresnel FFT', determines the propagation (see propagation_operator)
     Returns:
         pattern: interference pattern generated by the speckle field given in input
     """
 
-    dim = len(screen)
-    slits_dist = slits_dist / 10 # Convert lengths to cm
-    slit_width = slit_width / 10
-    wavelen = wavelen / 1e7
+    # Return the interference pattern
+    return propagation_operator(dist_2, slits_dist, slit_width, screen, wavelen, mode).patterns(field)
 
-    pattern = np.zeros(dim, dtype = complex)
+# dist_2 = 1e4 # [cm]
+# wavelen = 500 # [nm]
+# slit_width = 1 # [mm]
 
-    index = np.arange(dim)
-    slit_1 = np.logical_and(screen >= -slits_dist/2 - slit_width/2, screen <= -slits_dist/2 + slit_width/2)
-    slit_2 = np.logical_and(screen >= slits_dist/2 - slit_width/2, screen <= slits_dist/2 + slit_width/2)
-    slit_index = index[np.logical_or(slit_1, slit_2)]
+def window_max(vect, size):
+    """ Calculate the maximum of every window of a given size of an array, in a time which does not depend on the size (van Herk - Gil-Werman algorithm)
+    Arguments:
+        vect: numpy array (the windows run along the last axis)
+        size: number of points of the windows
+    Returns:
+        wmax: numpy array with wmax[j] = max(vect[j:j + size]), for j from 0 to len(vect) - size
+    """
 
-    for i in slit_index:
-        pattern += field[i] * np.exp(1j * 2 * np.pi * np.sqrt(dist_2 ** 2 + (screen[i] - screen) ** 2)/wavelen)/np.sqrt(1 + (screen[i] - screen) ** 2 / dist_2 ** 2)
+    dim = vect.shape[-1]
+    pad = (-dim) % size
+    padded = np.concatenate((vect, np.full(vect.shape[:-1] + (pad,), -np.inf)), axis = -1)
 
-    # Return the interference pattern and the profile.
-    return np.abs(pattern).real ** 2
+    # Running maximum from the start and from the end of each block of size points: a window starting at j is made of the end of the block of j and 
+    # of the start of the following block
+    blocks = padded.reshape(vect.shape[:-1] + (-1, size))
+    prefix = np.maximum.accumulate(blocks, axis = -1).reshape(padded.shape)
+    suffix = np.maximum.accumulate(blocks[..., ::-1], axis = -1)[..., ::-1].reshape(padded.shape)
 
-# dist_2 = 1e4 # [cm]
-# wavelen = 500 # [nm]
-# slit_width = 1 # [mm]
+    j = np.arange(dim - size + 1)
+    return np.maximum(suffix[..., j], prefix[..., j + size - 1])
+
+def range_max(vect, lo, hi):
+    """ Calculate the maximum of vect[lo[i]:hi[i]] for every i, with windows of any (nonzero) length
+    Arguments:
+        vect: numpy array (the windows run along the last axis)
+        lo: numpy array with the first index of each window
+        hi: numpy array with the index after the last one of each window
+    Returns:
+        rmax: numpy array with the maximum of each window
+    """
+
+    length = hi - lo
+    rmax = np.empty(vect.shape[:-1] + lo.shape)
+    power = np.floor(np.log2(length)).astype(int)
+
+    # Each window is covered by two (overlapping) windows whose size is the largest power of 2 not exceeding its length
+    for p in np.unique(power):
+        size = 2 ** p
+        wmax = window_max(vect, size)
+        sel = power == p
+        rmax[..., sel] = np.maximum(wmax[..., lo[sel]], wmax[..., hi[sel] - size])
+
+    return rmax
 
 def calc_extremal(vect, x_axis, tolerance):
     """ Calculate the extremal points of a function with tolerance to ignore fluctuations
     Arguments:
         vect: numpy array containing the y coordinates of the function graph
-        x_axis: numpy array containing the x coordinates of the function graph
+        x_axis: numpy array containing the x coordinates of the function graph (increasing)
         tolerance: x interval over which the point must be an absolute maximum or minimum in order to be considered an extremal point
     Returns:
         (vect_max, vect_min): tuple with the indices of the local maxima and the local minima
@@ -134,20 +968,271 @@ def calc_extremal(vect, x_axis, tolerance):
 
     dx = x_axis[1] - x_axis[0]
 
+    # Window of each point: the points with x_axis[i] - tolerance/2 < x < x_axis[i] + tolerance/2
+    lo = np.searchsorted(x_axis, x_axis - tolerance/2, side = 'right')
+    hi = np.searchsorted(x_axis, x_axis + tolerance/2, side = 'left')
+
+    is_max = vect == range_max(vect, lo, hi)
+    is_min = vect == -range_max(-vect, lo, hi)
+
+    # Walk along the candidates: after an extremal point, the following round(tolerance/(2 dx)) points are skipped
     i = 0
-    while i < len(vect):
-        if vect[i] == np.max(vect[np.logical_and(x_axis > x_axis[i] - tolerance/2, x_axis < x_axis[i] + tolerance/2)]):
-            vect_max.append(i)
-            i += round(tolerance/(2 * dx))
-        elif vect[i] == np.min(vect[np.logical_and(x_axis > x_axis[i] - tolerance/2, x_axis < x_axis[i] + tolerance/2)]):
-            vect_min.append(i)
-            i += round(tolerance/(2 * dx))
+    for c in np.flatnonzero(np.logical_or(is_max, is_min)):
+        if c < i:
+            continue
+        if is_max[c]:
+            vect_max.append(int(c))
         else:
-            i += 1
+            vect_min.append(int(c))
+        i = c + round(tolerance/(2 * dx))
 
-            
     return vect_max, vect_min
 
+def extremal_masks(vect, x_axis, tolerance):
+    """ Calculate the extremal points of a stack of functions sharing the same x axis, with tolerance to ignore fluctuations (same points of calc_extremal
+    for each function). The walk along the candidates of calc_extremal, which jumps from an extremal point to the first candidate at least
+    round(tolerance/(2 dx)) points after it, is followed for all the rows at once by pointer doubling
+    Arguments:
+        vect: numpy array with the y coordinates of one function per row
+        x_axis: numpy array containing the x coordinates of the functions (increasing)
+        tolerance: x interval over which the point must be an absolute maximum or minimum in order to be considered an extremal point
+    Returns:
+        (is_max, is_min): tuple with two boolean arrays of the same shape of vect, true on the local maxima and on the local minima
+    """
+    dim = vect.shape[-1]
+    dx = x_axis[1] - x_axis[0]
+
+    lo = np.searchsorted(x_axis, x_axis - tolerance/2, side = 'right')
+    hi = np.searchsorted(x_axis, x_axis + tolerance/2, side = 'left')
+
+    is_max = vect == range_max(vect, lo, hi)
+    is_min = vect == -range_max(-vect, lo, hi)
+
+    # Candidates of all the rows, as indices of the flattened array (sorted by row, then by column)
+    cand = np.flatnonzero(np.logical_or(is_max, is_min))
+    num = len(cand)
+    row = cand // dim
+
+    # From each candidate the walk jumps to the first candidate of the same row at least skip points after it (num, out of the candidates, ends the walk)
+    jump = np.searchsorted(cand, cand + round(tolerance/(2 * dx)), side = 'left')
+    jump[jump < num] = np.where(row[jump[jump < num]] == row[jump < num], jump[jump < num], num)
+    jump = np.append(jump, num)
+
+    # The walk of each row starts from its first candidate: after step p, the points reached in less than 2^p jumps are marked
+    visited = np.zeros(num + 1, dtype = bool)
+    visited[np.flatnonzero(np.diff(row, prepend = -1))] = True
+    for p in range(max(num, 1).bit_length()):
+        visited[jump[visited]] = True
+        jump = jump[jump]
+
+    accepted = np.zeros(vect.size, dtype = bool)
+    accepted[cand[visited[:num]]] = True
+    accepted = accepted.reshape(vect.shape)
+
+    return np.logical_and(is_max, accepted), np.logical_and(accepted, np.logical_not(is_max)) # A point both maximum and minimum is a maximum
+
+def envelope_shape(vect, B, k, points = None):
+    """ Calculate the shape of the envelope of the interference pattern (diffraction from a single slit) and its derivative with respect to the width B.
+    A slit sampled by a few points of the grid diffracts as an array of point sources: the envelope is the square of the Dirichlet kernel 
+    sin(pi t)/(points sin(pi t/points)), which tends to sinc(t) as the points increase
+    Arguments:
+        vect: numpy array with the coordinates on the screen in [cm]
+        B: width correction of the envelope (numpy array, broadcast against vect)
+        k: width of the slit over (wavelen dist_2) in [1/cm], the width being points dx for a sampled slit
+        points: number of points of the grid in the slit (None for a continuous slit)
+    Returns:
+        (u, du): tuple with the shape at t = B vect k (sinc(t)^2 for a continuous slit) and its derivative with respect to B
+    """
+    t = B * vect * k
+    if points is None:
+        s = np.sinc(t)
+        t_safe = np.where(t == 0, 1, t)
+        ds = np.where(t == 0, 0, (np.cos(np.pi * t) - s) / t_safe) # Derivative of the sinc
+    else:
+        den = points * np.sin(np.pi * t / points)
+        den_safe = np.where(den == 0, 1, den)
+        s = np.where(den == 0, 1, np.sin(np.pi * t) / den_safe)
+        ds = np.where(den == 0, 0, np.pi * (np.cos(np.pi * t) - s * np.cos(np.pi * t / points)) / den_safe) # Derivative of the kernel
+    return s ** 2, 2 * s * ds * vect * k
+
+def slit_point_count(screen, slits_dist, slit_width):
+    """ Number of points of the grid in either of the two slits (see slit_points), which sets the width and the height of the envelope of the patterns
+    Arguments:
+        screen: coordinates of the points on the screen in [cm]
+        slits_dist: distance between the two slits in [cm]
+        slit_width: width of either of the two slits in [cm]
+    Returns:
+        points: number of points of a slit (the mean of the two)
+    """
+    return len(slit_points(screen, slits_dist, slit_width)) / 2
+
+def fit_envelope(x_max, y_max, x_min, y_min, scale, k, B_grid = np.linspace(0.05, 5, 100), B_0 = None, points = None):
+    """ Fit the upper and lower envelopes of an interference pattern, scale * A * (1 +- vis) * u(B x k) with u the shape of envelope_shape, to its maxima 
+    and minima, minimizing the sum of the mean square residuals of the two. For a fixed B the envelopes are linear in A (1 + vis) and A (1 - vis), which 
+    are then given by a linear least squares solution (variable projection): only B is searched, first on a grid and then refined with the analytic 
+    gradient
+    Arguments:
+        x_max: numpy array with the coordinates of the maxima in [cm]
+        y_max: numpy array with the values of the pattern at the maxima
+        x_min: numpy array with the coordinates of the minima in [cm]
+        y_min: numpy array with the values of the pattern at the minima
+        scale: amplitude factor of the envelopes
+        k: width of the slit over (wavelen dist_2) in [1/cm] (see envelope_shape)
+        B_grid: values of B on which the first search is made
+        B_0: starting value of B (warm start, e.g. from the fit of a similar pattern): the grid search is skipped, unless the refinement does not 
+            converge within one step of the grid from B_0
+        points: number of points of the grid in a slit (see envelope_shape)
+    Returns:
+        (popt, info): tuple with the fit parameters [A, B, vis] (NaN if there are no maxima or minima) and a dictionary with the residual ('fun'), the 
+        number of iterations ('nit') and of function evaluations ('nfev'), whether the refinement converged ('success') and whether the warm start was 
+        kept ('warm')
+    """
+
+    def linear_solution(u_max, u_min):
+        # Best amplitudes p = scale A (1 + vis), q = scale A (1 - vis) for the given shapes
+        p = np.sum(u_max * y_max, axis = -1) / np.sum(u_max ** 2, axis = -1)
+        q = np.sum(u_min * y_min, axis = -1) / np.sum(u_min ** 2, axis = -1)
+        return p, q
+
+    norm = np.mean(y_max ** 2) + np.mean(y_min ** 2) # The residual is divided by this, so that the tolerances of the refinement are meaningful
+
+    def reduced(B_vect):
+        # Residual as a function of B only, and its gradient (the linear parameters are optimal, so their derivatives do not contribute)
+        B = B_vect[0]
+        u_max, du_max = envelope_shape(x_max, B, k, points)
+        u_min, du_min = envelope_shape(x_min, B, k, points)
+        p, q = linear_solution(u_max, u_min)
+        res_max = p * u_max - y_max
+        res_min = q * u_min - y_min
+        fun = np.mean(res_max ** 2) + np.mean(res_min ** 2)
+        grad = 2 * np.mean(res_max * p * du_max) + 2 * np.mean(res_min * q * du_min)
+        return fun / norm, np.array([grad / norm])
+
+    bounds = [(B_grid[0] / 10, B_grid[-1] * 2)]
+    nit = 0
+    nfev = 0
+
+    if B_0 is not None:
+        res = minimize(reduced, x0 = [B_0], jac = True, method = 'L-BFGS-B', bounds = bounds)
+        nit += res.nit
+        nfev += res.nfev
+        warm = res.success and abs(res.x[0] - B_0) <= B_grid[1] - B_grid[0] # Otherwise the minimum may be another one, fall back to the cold start
+
+    if B_0 is None or not warm:
+        # Search on the grid, all at once
+        u_max = envelope_shape(x_max[None, :], B_grid[:, None], k, points)[0]
+        u_min = envelope_shape(x_min[None, :], B_grid[:, None], k, points)[0]
+        p, q = linear_solution(u_max, u_min)
+        fun_grid = np.mean((p[:, None] * u_max - y_max) ** 2, axis = 1) + np.mean((q[:, None] * u_min - y_min) ** 2, axis = 1)
+        if np.all(np.isnan(fun_grid)): # No maxima or minima (e.g. a flat pattern): there is nothing to fit
+            return np.full(3, np.nan), {'fun': np.nan, 'nit': nit, 'nfev': nfev + len(B_grid), 'success': False, 'warm': False}
+        B_start = B_grid[np.nanargmin(fun_grid)]
+
+        res = minimize(reduced, x0 = [B_start], jac = True, method = 'L-BFGS-B', bounds = bounds)
+        nit += res.nit
+        nfev += res.nfev + len(B_grid)
+        warm = False
+
+    B = res.x[0]
+
+    p, q = linear_solution(envelope_shape(x_max, B, k, points)[0], envelope_shape(x_min, B, k, points)[0])
+    popt = np.array([(p + q) / (2 * scale), B, (p - q) / (p + q)])
+
+    return popt, {'fun': res.fun * norm, 'nit': nit, 'nfev': nfev, 'success': res.success, 'warm': warm}
+
+def masked_points(mask):
+    """ Collect the indices of the points of a stack of patterns selected by a mask into rows of the same length
+    Arguments:
+        mask: boolean numpy array with one row per pattern
+    Returns:
+        (index, w): tuple with a numpy array with the indices of the selected points of each pattern, padded with zeros to the largest number of points, 
+        and with the weights (1 on the selected points, 0 on the padding)
+    """
+    rows, cols = np.nonzero(mask)
+    count = np.sum(mask, axis = 1)
+    pos = np.arange(len(rows)) - np.repeat(np.cumsum(count) - count, count) # Position of each point within its row
+
+    index = np.zeros((len(mask), max(np.max(count, initial = 0), 1)), dtype = int)
+    w = np.zeros(index.shape)
+    index[rows, pos] = cols
+    w[rows, pos] = 1
+
+    return index, w
+
+def fit_envelopes(screen, patterns, is_max, is_min, scale, k, B_grid = np.linspace(0.05, 5, 100), iterations = 30, points = None):
+    """ Fit the envelopes of a stack of interference patterns sharing the same screen, as fit_envelope does for one pattern, with array operations over 
+    the whole stack: the residuals of all the patterns are calculated at once on the grid of B (with the shapes calculated once on the screen), and the 
+    refinement is a golden section search of B around the best point of the grid, made for all the patterns at once
+    Arguments:
+        screen: coordinates of the points on the screen in [cm]
+        patterns: numpy array with one interference pattern per row
+        is_max: boolean numpy array of the same shape of patterns, true on the maxima (see extremal_masks)
+        is_min: boolean numpy array of the same shape of patterns, true on the minima
+        scale: numpy array with the amplitude factor of the envelopes of each pattern
+        k: width of the slit over (wavelen dist_2) in [1/cm] (see envelope_shape)
+        B_grid: values of B on which the first search is made (equally spaced)
+        iterations: number of steps of the golden section search
+        points: number of points of the grid in a slit, the same for all the patterns (see envelope_shape)
+    Returns:
+        (popt, fun): tuple with a numpy array with the fit parameters [A, B, vis] of each pattern (one per row, NaN for a pattern without maxima or
+        minima) and a numpy array with the residuals
+    """
+
+    rows = np.arange(len(patterns))[:, None]
+    i_max, w_max = masked_points(is_max)
+    i_min, w_min = masked_points(is_min)
+    x_max, y_max = screen[i_max], patterns[rows, i_max]
+    x_min, y_min = screen[i_min], patterns[rows, i_min]
+
+    yw_max, yw_min = w_max * y_max, w_min * y_min # The padding has zero weight
+    y2_max, y2_min = np.sum(yw_max * y_max, axis = 1), np.sum(yw_min * y_min, axis = 1)
+    n_max, n_min = np.sum(w_max, axis = 1), np.sum(w_min, axis = 1)
+
+    def reduced(u_max, u_min):
+        # Residual of each pattern with the best amplitudes p = scale A (1 + vis), q = scale A (1 - vis) for the given shapes (the last axis runs over the 
+        # points): with p = sum(u y)/sum(u^2) the sum of the square residuals is sum(y^2) - p sum(u y)
+        uy_max, uy_min = np.sum(yw_max * u_max, axis = -1), np.sum(yw_min * u_min, axis = -1)
+        p = uy_max / np.sum(w_max * u_max ** 2, axis = -1)
+        q = uy_min / np.sum(w_min * u_min ** 2, axis = -1)
+        return (y2_max - p * uy_max) / n_max + (y2_min - q * uy_min) / n_min, p, q
+
+    def shapes(B):
+        # Shapes of the envelopes of each pattern for its own B
+        return envelope_shape(x_max, B[:, None], k, points)[0], envelope_shape(x_min, B[:, None], k, points)[0]
+
+    # Search on the grid, for all the patterns at once: the shapes only depend on the point of the screen
+    # (one value of B at a time, so that the temporary arrays are no larger than the points of the stack)
+    table = envelope_shape(screen[None, :], B_grid[:, None], k, points)[0]
+    fun_grid = np.array([reduced(u[i_max], u[i_min])[0] for u in table])
+    empty = np.all(np.isnan(fun_grid), axis = 0) # No maxima or minima (e.g. a flat pattern): there is nothing to fit
+    best = np.nanargmin(np.where(empty, 0, fun_grid), axis = 0)
+
+    # Golden section search between the neighbours of the best point of the grid
+    step = B_grid[1] - B_grid[0]
+    lo = B_grid[best] - step
+    hi = B_grid[best] + step
+    ratio = (np.sqrt(5) - 1) / 2
+    B_1 = hi - ratio * (hi - lo)
+    B_2 = lo + ratio * (hi - lo)
+    f_1 = reduced(*shapes(B_1))[0]
+    f_2 = reduced(*shapes(B_2))[0]
+
+    for i in range(iterations):
+        left = f_1 < f_2 # The minimum is in [lo, B_2]
+        hi = np.where(left, B_2, hi)
+        lo = np.where(left, lo, B_1)
+        B_new = np.where(left, hi - ratio * (hi - lo), lo + ratio * (hi - lo))
+        f_new = reduced(*shapes(B_new))[0]
+        B_1, f_1, B_2, f_2 = np.where(left, B_new, B_2), np.where(left, f_new, f_2), np.where(left, B_1, B_new), np.where(left, f_1, f_new)
+
+    B = (lo + hi) / 2
+    fun, p, q = reduced(*shapes(B))
+    popt = np.stack([(p + q) / (2 * scale), B, (p - q) / (p + q)], axis = 1)
+    popt[empty] = np.nan
+    fun[empty] = np.nan
+
+    return popt, fun
+
 def process_pattern(pattern_data, slit_width, wavelen, dist_2, guess, A_1):
     """
     Calculate the upper and lower profile of a given interference pattern, use it to normalize the pattern itself, calculate the pattern visibility
@@ -156,8 +1241,8 @@ def process_pattern(pattern_data, slit_width, wavelen, dist_2, guess, A_1):
         slit_width: width of either of the two slits which produce the interference in [mm]
         wavelen: wavelength of the light in [nm]
         dist_2: distance from the double slit to the screen in [cm]
-        guess: first guess for the visibility fit parameter
-        A_1: first guess for the amplitude fit parameter
+        guess: first guess for the visibility fit parameter (no longer needed by the fit, kept for the preliminary analysis)
+        A_1: first guess for the amplitude fit parameter (no longer needed by the fit, kept for the preliminary analysis)
     Returns:
         (patt_data_proc, patt_data_norm, vis): tuple containing: a pandas dataframe with the pattern, the screen and the two profiles; a pandas dataframe with 
         the normalized pattern and the screen; the numerical value of the visibility.
@@ -170,37 +1255,31 @@ def process_pattern(pattern_data, slit_width, wavelen, dist_2, guess, A_1):
     with open('numbers.txt', 'r') as f:
         avg_intensity = float(f.read())
 
-    def fit_up(vect, A, B, vis): # Function for fitting the upper profile
-        return avg_intensity * 2 * A * (1 + vis) * np.sinc(B * vect * slit_width / (wavelen * dist_2)) ** 2 * (slit_width / dx) ** 2 * (filter_width * dx) / (np.pi * 2)
-    
-    def fit_down(vect, A, B, vis): # Function for fitting the lower profile
-        return avg_intensity * 2 * A * (1 - vis) * np.sinc(B * vect * slit_width / (wavelen * dist_2)) ** 2 * (slit_width / dx) ** 2 * (filter_width * dx) / (np.pi * 2)
+    # Same fit and visibility of fit_pattern, so that a single pattern gets the visibility of the analysis of the whole run
+    vis, pha, popt, info = fit_pattern(pattern_data, slit_width, wavelen, dist_2, avg_intensity)
 
     slits_dist = slits_dist / 10 # Convert lengths to cm
     slit_width = slit_width / 10
     wavelen = wavelen / 1e7 
 
-    tolerance = 0.1 # [cm] (consider adding this as an input)
-
     screen = pattern_data['screen'].to_numpy()
     pattern = pattern_data['pattern'].to_numpy()
 
     dx = screen[1] - screen[0]
 
-    pattern_cut = pattern[np.logical_and(screen >= -cut, screen <= cut)] # Cut away uninteresting part (the approximation used for the fit only works for small y)
-    screen_cut = screen[np.logical_and(screen >= -cut, screen <= cut)]
-
-    patt_max, patt_min = calc_extremal(pattern, screen, tolerance)
+    # The envelope is the one of the points of the grid in the slits (see fit_pattern)
+    points = slit_point_count(screen, slits_dist, slit_width)
+    k = points * dx / (wavelen * dist_2)
+    scale = avg_intensity * 2 * points ** 2 * (filter_width * dx) / (np.pi * 2)
 
-    def func_1(xx):
-        aa, bb, v = xx[0], xx[1], xx[2]
-        return np.mean((fit_up(screen[patt_max], aa, bb, v) - pattern[patt_max]) ** 2) + np.mean((fit_down(screen[patt_min], aa, bb, v) - pattern[patt_min]) ** 2)
+    def fit_up(vect, A, B, vis): # Upper profile
+        return scale * A * (1 + vis) * envelope_shape(vect, B, k, points)[0]
     
-    res = minimize(func_1, x0 = [A_1, 1, guess])
-    popt = res.x
+    def fit_down(vect, A, B, vis): # Lower profile
+        return scale * A * (1 - vis) * envelope_shape(vect, B, k, points)[0]
 
-    # popt_up, pcov_up = curve_fit(fit_up, screen_cut[patt_max], pattern_cut[patt_max], p0 = (guess, A_1))
-    # popt_down, pcov_up = curve_fit(fit_down, screen_cut[patt_min], pattern_cut[patt_min], p0 = (guess, A_2))
+    pattern_cut = pattern[np.logical_and(screen >= -cut, screen <= cut)] # Cut away uninteresting part (the approximation used for the fit only works for small y)
+    screen_cut = screen[np.logical_and(screen >= -cut, screen <= cut)]
 
     patt_up = fit_up(screen, *popt)
     patt_down = fit_down(screen, *popt)
@@ -220,13 +1299,8 @@ def process_pattern(pattern_data, slit_width, wavelen, dist_2, guess, A_1):
         'screen_cut': screen_cut,
         'patt_norm': patt_norm
     })
-
-    # Calculation of visibility
-
-    vis = (np.max(patt_norm) - np.min(patt_norm)) / (np.max(patt_norm) + np.min(patt_norm)) 
-    # The normalized pattern should be a sinusoid, so the maximum and the minimum are well defined
     
-    return patt_data_proc, patt_data_norm, round(vis, 3)
+    return patt_data_proc, patt_data_norm, vis
 
 def pre_process(pattern_data, slit_width, wavelen, dist_2, options, guess, A_1):
     """
@@ -285,8 +1359,11 @@ def pre_process(pattern_data, slit_width, wavelen, dist_2, options, guess, A_1):
             with open('numbers.txt', 'r') as f:
                 avg_intensity = float(f.read())
             
-            prof_up = avg_intensity * 2 * A_1 * (1 + guess) * np.sinc(screen * slit_width / (wavelen * dist_2)) ** 2 * (slit_width / dx) ** 2 * (filter_width * dx) / (np.pi * 2)
-            prof_down = avg_intensity * 2 * A_1 * (1 - guess) * np.sinc(screen * slit_width / (wavelen * dist_2)) ** 2 * (slit_width / dx) ** 2 * (filter_width * dx) / (np.pi * 2)
+            # Envelopes of the fit (see fit_pattern) with B = 1
+            points = slit_point_count(screen, slits_dist, slit_width)
+            shape = envelope_shape(screen, 1, points * dx / (wavelen * dist_2), points)[0]
+            prof_up = avg_intensity * 2 * A_1 * (1 + guess) * shape * points ** 2 * (filter_width * dx) / (np.pi * 2)
+            prof_down = avg_intensity * 2 * A_1 * (1 - guess) * shape * points ** 2 * (filter_width * dx) / (np.pi * 2)
 
             guess_data = pd.DataFrame({
                 'screen': screen,
@@ -300,35 +1377,34 @@ def pre_process(pattern_data, slit_width, wavelen, dist_2, options, guess, A_1):
 
     return fig_data, fig_layout
 
-def fast_process(pattern_data, slit_width, wavelen, dist_2):
-    """ Calculate the visibility of a pattern automatically, more roughly, without using the fit
+def fit_pattern(pattern_data, slit_width, wavelen, dist_2, avg_intensity = None, B_0 = None):
+    """ Calculate the visibility of a pattern from the fit of its envelopes (the work of fast_process), also returning the fit
     Arguments: 
         pattern_data: pandas dataframe containing the interference pattern and the screen coordinates in [cm]
         slit_width: width of either of the two slits which produce the interference in [mm]
         wavelen: wavelength of the light in [nm]
         dist_2: distance from the double slit to the screen in [cm]
+        avg_intensity: average intensity of the speckle fields (read from numbers.txt if not given)
+        B_0: starting value of the width correction of the envelopes (see fit_envelope)
     Returns:
-        vis: the numerical value of the visibility
+        (vis, pha, popt, info): tuple with the visibility, the sign of the correlation function, the fit parameters [A, B, vis] and the information on
+        the fit returned by fit_envelope
     """
 
     cut = 15 # [cm]
     slits_dist = pattern_data['slits_dist'][0]
     filter_width = pattern_data['filter_width'].to_numpy()[0]
 
-    with open('numbers.txt', 'r') as f:
-        avg_intensity = float(f.read())
-
-    def fit_up(vect, A, B, vis): # Function for fitting the upper profile
-        return avg_intensity * 2 * A * (1 + vis) * np.sinc(B * vect * slit_width / (wavelen * dist_2)) ** 2 * (slit_width / dx) ** 2 * (filter_width * dx) / (np.pi * 2)
-    
-    def fit_down(vect, A, B, vis): # Function for fitting the lower profile
-        return avg_intensity * 2 * A * (1 - vis) * np.sinc(B * vect * slit_width / (wavelen * dist_2)) ** 2 * (slit_width / dx) ** 2 * (filter_width * dx) / (np.pi * 2)
+    if avg_intensity is None:
+        with open('numbers.txt', 'r') as f:
+            avg_intensity = float(f.read())
 
     slits_dist = slits_dist / 10 # Convert lengths to cm
     slit_width = slit_width / 10
     wavelen = wavelen / 1e7 
 
     tolerance = 0.1 # [cm] (consider adding this as an input)
+    envelope_fraction = 0.8 # Fraction of the way to the first zero of the envelope which is used for the visibility
 
     screen = pattern_data['screen'].to_numpy()
     pattern = pattern_data['pattern'].to_numpy()
@@ -340,26 +1416,20 @@ def fast_process(pattern_data, slit_width, wavelen, dist_2):
 
     patt_max, patt_min = calc_extremal(pattern, screen, tolerance)
 
-    def func_1(xx):
-        aa, bb, v = xx[0], xx[1], xx[2]
-        return np.mean((fit_up(screen[patt_max], aa, bb, v) - pattern[patt_max]) ** 2) + np.mean((fit_down(screen[patt_min], aa, bb, v) - pattern[patt_min]) ** 2)
-    
-    res = minimize(func_1, x0 = [1, 1, 0.5])
-    popt = res.x
-
-    # popt_up, pcov_up = curve_fit(fit_up, screen_cut[patt_max], pattern_cut[patt_max], p0 = (guess, A_1))
-    # popt_down, pcov_up = curve_fit(fit_down, screen_cut[patt_min], pattern_cut[patt_min], p0 = (guess, A_2))
-
-    # patt_up = fit_up(screen, *popt)
-    # patt_down = fit_down(screen, *popt)
+    # Fit of the profiles: the envelope is the one of the points of the grid in the slits, whose number depends on the grid and on the slit separation
+    points = slit_point_count(screen, slits_dist, slit_width)
+    k = points * dx / (wavelen * dist_2)
+    scale = avg_intensity * 2 * points ** 2 * (filter_width * dx) / (np.pi * 2)
+    popt, info = fit_envelope(screen[patt_max], pattern[patt_max], screen[patt_min], pattern[patt_min], scale, k, B_0 = B_0, points = points)
 
-    norm = fit_up(screen_cut, *popt)
+    norm = scale * popt[0] * (1 + popt[2]) * envelope_shape(screen_cut, popt[1], k, points)[0] # Upper envelope
 
     patt_norm = pattern_cut/norm # Normalized pattern
+    inner = np.abs(screen_cut) <= min(cut, envelope_fraction / k) # Away from the first zero of the envelope (see batch_process)
 
     # Calculation of visibility
 
-    vis = (np.max(patt_norm) - np.min(patt_norm)) / (np.max(patt_norm) + np.min(patt_norm)) 
+    vis = (np.max(patt_norm[inner]) - np.min(patt_norm[inner])) / (np.max(patt_norm[inner]) + np.min(patt_norm[inner])) 
     # The normalized pattern should be a sinusoid, so the maximum and the minimum are well defined
 
     pha = 0 # Phase of the correlation function
@@ -372,16 +1442,484 @@ def fast_process(pattern_data, slit_width, wavelen, dist_2):
 
     # Calculation of visibility
 
-    vis = (np.max(patt_norm) - np.min(patt_norm)) / (np.max(patt_norm) + np.min(patt_norm)) 
+    vis = (np.max(patt_norm[inner]) - np.min(patt_norm[inner])) / (np.max(patt_norm[inner]) + np.min(patt_norm[inner])) 
     # The normalized pattern should be a sinusoid, so the maximum and the minimum are well defined
     
-    return round(vis, 3), pha
+    return round(vis, 3), pha, popt, info
 
-def FWHM(vect, x_axis):
-    """ Calculate the FWHM of a peaked function
-    Arguments:
-        vect: numpy array containing the y coordinates of the function graph
-        x_axis: numpy array containing the x coordinates of the function graph
+def fast_process(pattern_data, slit_width, wavelen, dist_2, avg_intensity = None):
+    """ Calculate the visibility of a pattern automatically, more roughly, without using the fit
+    Arguments: 
+        pattern_data: pandas dataframe containing the interference pattern and the screen coordinates in [cm]
+        slit_width: width of either of the two slits which produce the interference in [mm]
+        wavelen: wavelength of the light in [nm]
+        dist_2: distance from the double slit to the screen in [cm]
+        avg_intensity: average intensity of the speckle fields (read from numbers.txt if not given)
+    Returns:
+        vis: the numerical value of the visibility
+    """
+    return fit_pattern(pattern_data, slit_width, wavelen, dist_2, avg_intensity)[:2]
+
+def sweep_process(data, slit_width, wavelen, dist_2, avg_intensity = None, warm_start = True):
+    """ Calculate the visibility of a list of patterns of a sweep, fitting them in order of filter width and slit separation: neighbouring patterns
+    have nearly the same envelopes, so each fit starts from the width found for the previous one
+    Arguments: 
+        data: list of pandas dataframes containing the interference patterns and the screen coordinates in [cm]
+        slit_width: width of either of the two slits which produce the interference in [mm]
+        wavelen: wavelength of the light in [nm]
+        dist_2: distance from the double slit to the screen in [cm]
+        avg_intensity: average intensity of the speckle fields (read from numbers.txt if not given)
+        warm_start: whether each fit starts from the previous one (if False every fit starts from the grid search, as in fast_process)
+    Returns:
+        (results, counts): tuple with a list of tuples (vis, pha) in the order of data, and a dictionary with the total number of iterations ('nit') and 
+        of function evaluations ('nfev') of the fits and the number of warm starts kept ('warm')
+    """
+
+    if avg_intensity is None:
+        with open('numbers.txt', 'r') as f:
+            avg_intensity = float(f.read())
+
+    order = sorted(range(len(data)), key = lambda i: (data[i]['filter_width'][0], data[i]['slits_dist'][0]))
+
+    results = [None] * len(data)
+    counts = {'nit': 0, 'nfev': 0, 'warm': 0}
+    B_0 = None
+
+    for i in order:
+        vis, pha, popt, info = fit_pattern(data[i], slit_width, wavelen, dist_2, avg_intensity, B_0)
+        results[i] = (vis, pha)
+        for key in counts:
+            counts[key] += info[key]
+        if warm_start:
+            B_0 = popt[1]
+
+    return results, counts
+
+def batch_process(screen, patterns, slits_dist, filter_width, slit_width, wavelen, dist_2, avg_intensity = None):
+    """ Calculate the visibility of a stack of patterns sharing the same screen, as fast_process does for one pattern, with array operations over the 
+    whole stack (the extremal points are found with extremal_masks and the envelopes are fitted with fit_envelopes)
+    Arguments: 
+        screen: coordinates of the points on the screen in [cm]
+        patterns: numpy array with one interference pattern per row
+        slits_dist: numpy array with the distance between the slits of each pattern in [mm]
+        filter_width: numpy array with the filter width of each pattern
+        slit_width: width of either of the two slits which produce the interference in [mm]
+        wavelen: wavelength of the light in [nm]
+        dist_2: distance from the double slit to the screen in [cm]
+        avg_intensity: average intensity of the speckle fields (read from numbers.txt if not given)
+    Returns:
+        (vis, pha, popt): tuple with numpy arrays of the visibilities, of the signs of the correlation function and of the fit parameters [A, B, vis] 
+        (one row per pattern)
+    """
+
+    cut = 15 # [cm]
+
+    if avg_intensity is None:
+        with open('numbers.txt', 'r') as f:
+            avg_intensity = float(f.read())
+
+    slits_dist = np.asarray(slits_dist) / 10 # Convert lengths to cm
+    slit_width = slit_width / 10
+    wavelen = wavelen / 1e7 
+
+    tolerance = 0.1 # [cm]
+    envelope_fraction = 0.8 # Fraction of the way to the first zero of the envelope which is used for the visibility
+
+    dx = screen[1] - screen[0]
+
+    is_max, is_min = extremal_masks(patterns, screen, tolerance)
+
+    # Fit of the profiles: the envelope is the one of the points of the grid in the slits (see fit_pattern), the patterns with the same number of 
+    # points are fitted together
+    points = np.array([slit_point_count(screen, d, slit_width) for d in slits_dist])
+    k = points * dx / (wavelen * dist_2)
+    scale = avg_intensity * 2 * points ** 2 * (np.asarray(filter_width) * dx) / (np.pi * 2)
+    popt = np.empty((len(patterns), 3))
+    for n in np.unique(points):
+        group = points == n
+        popt[group] = fit_envelopes(screen, patterns[group], is_max[group], is_min[group], scale[group], n * dx / (wavelen * dist_2), points = n)[0]
+
+    inside = np.logical_and(screen >= -cut, screen <= cut) # Cut away uninteresting part
+    screen_cut = screen[inside]
+    norm = (scale * popt[:, 0] * (1 + popt[:, 2]))[:, None] * envelope_shape(screen_cut[None, :], popt[:, 1:2], k[:, None], points[:, None])[0]
+
+    patt_norm = patterns[:, inside] / norm # Normalized patterns
+    # Near the first zero of the envelope (at 1/k) the normalized pattern is mostly noise: stop at a fraction of the way to it (on the production grid
+    # the whole cut is kept, while on a coarse grid a slit of a few points has a narrower envelope)
+    edge = np.abs(screen_cut)[None, :] > np.minimum(cut, envelope_fraction / k)[:, None]
+    patt_max = np.max(np.where(edge, -np.inf, patt_norm), axis = 1)
+    patt_min = np.min(np.where(edge, np.inf, patt_norm), axis = 1)
+
+    vis = (patt_max - patt_min) / (patt_max + patt_min)
+
+    center = round(len(screen_cut) / 2) # Center of the screen
+    period = np.round(wavelen * dist_2 / (slits_dist * dx)).astype(int)
+    rows = np.arange(len(patterns))
+    pha = np.where(patt_norm[rows, center] > patt_norm[rows, center + period], 1, -1) # 1 when the center is a maximum
+
+    return vis, pha, popt # Full precision, as the replicas of visibility_error need it (rounded only when saved)
+
+def sideband_visibility(screen, patterns, slits_dist, wavelen, dist_2):
+    """ Calculate the visibility and the phase of one or more patterns from their spectrum, without extremal points nor fit.
+    The fringes at frequency slits_dist/(wavelen*dist_2) appear in the spectrum as a sideband of the envelope, which sits around
+    zero frequency: the two bands are separated and transformed back, so that the ratio of the (complex) sideband to the envelope
+    is half the visibility, and its argument is the phase of the correlation function
+    Arguments: 
+        screen: coordinates of the points on the screen in [cm]
+        patterns: numpy array with an interference pattern (or one per row)
+        slits_dist: distance between the slits in [mm]
+        wavelen: wavelength of the light in [nm]
+        dist_2: distance from the double slit to the screen in [cm]
+    Returns:
+        (vis, pha): tuple with the visibility and the sign of the correlation function (1 if the center of the screen is a maximum, -1 if it is a 
+        minimum) of each pattern
+    """
+
+    slits_dist = slits_dist / 10 # Convert lengths to cm
+    wavelen = wavelen / 1e7
+
+    dim = len(screen)
+    dx = screen[1] - screen[0]
+    span = screen[-1] - screen[0]
+
+    n_fft = next_fast_len(2 * dim) # Zero padding, so that the two edges of the screen do not wrap around onto each other
+    freq = fftfreq(n_fft, dx)
+    spectrum = fft(patterns, n_fft)
+
+    f0 = slits_dist / (wavelen * dist_2) # Fringe frequency [1/cm]
+    # Each band is half the fringe frequency wide, so the slits need not sit exactly at slits_dist on the screen grid
+    envelope = ifft(spectrum * (np.abs(freq) < f0 / 2))[..., :dim].real
+    sideband = ifft(spectrum * (np.abs(freq - f0) < f0 / 2))[..., :dim]
+
+    # Average over the screen weighting the center, where the pattern is brighter and far from the edges
+    weight = np.cos(np.pi * (screen - (screen[0] + screen[-1]) / 2) / span) ** 2
+    vis = 2 * np.sum(weight * np.abs(sideband), axis = -1) / np.sum(weight * envelope, axis = -1)
+
+    center = round(dim / 2) # Center of the screen
+    pha = np.where((sideband[..., center] * np.exp(-2j * np.pi * f0 * screen[center])).real > 0, 1, -1) # 1 when the center is a maximum
+
+    return vis, pha
+
+def spectral_process(pattern_data, slit_width, wavelen, dist_2):
+    """ Calculate the visibility and the phase of a pattern from its spectrum, without extremal points nor fit (see sideband_visibility)
+    Arguments: 
+        pattern_data: pandas dataframe containing the interference pattern and the screen coordinates in [cm]
+        slit_width: width of either of the two slits which produce the interference in [mm] (not needed, kept for the same signature of fast_process)
+        wavelen: wavelength of the light in [nm]
+        dist_2: distance from the double slit to the screen in [cm]
+    Returns:
+        vis: the numerical value of the visibility
+        pha: sign of the correlation function (1 if the center of the screen is a maximum, -1 if it is a minimum)
+    """
+    vis, pha = sideband_visibility(pattern_data['screen'].to_numpy(), pattern_data['pattern'].to_numpy(), pattern_data['slits_dist'][0], wavelen, dist_2)
+    return round(float(vis), 3), int(pha)
+
+def replicate_patterns(groups, error_mode, replicas = 100, rng = None):
+    """ Build replicas of a pattern from the partial sums of its groups of fields, normalized to the whole ensemble (the pattern is a sum over the fields)
+    Arguments:
+        groups: numpy array with the partial sum of the pattern over each group of fields (one per row)
+        error_mode: a string, 'Jackknife' (leave out one group at a time) or 'Bootstrap' (resample the groups with replacement)
+        replicas: number of bootstrap replicas
+        rng: numpy random generator for the bootstrap
+    Returns:
+        numpy array with one replica of the pattern per row
+    """
+    num = len(groups)
+
+    if error_mode == 'Bootstrap':
+        rng = np.random.default_rng(0) if rng is None else rng
+        weights = rng.multinomial(num, np.full(num, 1 / num), size = replicas).astype(float)
+    else:
+        weights = (1 - np.eye(num)) * num / (num - 1)
+
+    return weights @ groups
+
+def visibility_error(pattern_data, groups, analysis_mode, error_mode, slit_width, wavelen, dist_2, avg_intensity = None):
+    """ Estimate the standard error of the visibility of a pattern, from the visibilities of replicas of the pattern built from the partial sums 
+    of groups of fields (see replicate_patterns). The replicas are analyzed all at once, with batch_process or sideband_visibility
+    Arguments:
+        pattern_data: pandas dataframe containing the interference pattern and the screen coordinates in [cm]
+        groups: numpy array with the partial sum of the pattern over each group of fields (one per row)
+        analysis_mode: a string, 'Envelope fit', 'Batch envelope fit' or 'Fourier sideband', determines the visibility estimator
+        error_mode: a string, 'Jackknife' or 'Bootstrap'
+        slit_width: width of either of the two slits which produce the interference in [mm]
+        wavelen: wavelength of the light in [nm]
+        dist_2: distance from the double slit to the screen in [cm]
+        avg_intensity: average intensity of the speckle fields (read from numbers.txt if not given)
+    Returns:
+        err: standard error of the visibility
+    """
+    replicas = replicate_patterns(groups, error_mode)
+
+    if analysis_mode == 'Fourier sideband':
+        vis = sideband_visibility(pattern_data['screen'].to_numpy(), replicas, pattern_data['slits_dist'][0], wavelen, dist_2)[0]
+    else:
+        num = len(replicas)
+        vis = batch_process(pattern_data['screen'].to_numpy(), replicas, np.full(num, pattern_data['slits_dist'][0]), 
+                            np.full(num, pattern_data['filter_width'][0]), slit_width, wavelen, dist_2, avg_intensity)[0]
+
+    if error_mode == 'Bootstrap':
+        return np.std(vis, ddof = 1)
+    else:
+        return np.sqrt((len(vis) - 1) * np.mean((vis - np.mean(vis)) ** 2))
+
+def ensemble_error(config, groups, slits_dist, filter_width):
+    """ Estimate the standard error of the visibility of a pattern while its fields are being summed, with the jackknife over the groups of fields and 
+    the Fourier-sideband estimator (which needs no fit, nor the average intensity of the fields)
+    Arguments:
+        config: SimulationConfig of the pattern
+        groups: numpy array with the partial sum of the pattern over each group of fields (one per row)
+        slits_dist: distance between the slits in [mm]
+        filter_width: width of the filter
+    Returns:
+        err: standard error of the visibility
+    """
+    pattern_data = pd.DataFrame({
+        'screen': config.screen,
+        'pattern': groups.sum(axis = 0),
+        'filter_width': filter_width,
+        'slits_dist': slits_dist
+    })
+    return visibility_error(pattern_data, groups, 'Fourier sideband', 'Jackknife', config.slit_width, config.wavelen, config.dist_2)
+
+def analyze_data(data, groups, config, analysis_mode, error_mode, avg_intensity = None):
+    """ Analyze a list of patterns held in memory, sharing the same configuration
+    Arguments:
+        data: list of pandas dataframes, in the format of read_pattern
+        groups: list with the partial sums of each pattern over groups of fields (None for the patterns without them)
+        config: SimulationConfig of the patterns
+        analysis_mode: a string, 'Envelope fit', 'Batch envelope fit' or 'Fourier sideband', determines the visibility estimator
+        error_mode: a string, 'None', 'Jackknife' or 'Bootstrap', determines how the standard error of the visibility is estimated (see visibility_error)
+        avg_intensity: average intensity of the speckle fields (read from numbers.txt if not given)
+    Returns:
+        results: list with a tuple (slits_dist, filter_width, filter_type, vis, pha, err) for each pattern: its parameters, its visibility, the sign of
+        the correlation function and the standard error of the visibility (nan if not estimated)
+    """
+    slit_width, wavelen, dist_2 = config.slit_width, config.wavelen, config.dist_2
+    slits_dist = [pattern_data['slits_dist'][0] for pattern_data in data]
+    filter_width = [pattern_data['filter_width'][0] for pattern_data in data]
+    filter_type = [pattern_data['filter_type'][0] for pattern_data in data]
+
+    if analysis_mode == 'Batch envelope fit': # All the patterns at once (they share the screen)
+        patterns = np.stack([pattern_data['pattern'].to_numpy() for pattern_data in data])
+        vis, pha = batch_process(data[0]['screen'].to_numpy(), patterns, slits_dist, filter_width, slit_width, wavelen, dist_2, avg_intensity)[:2]
+    elif analysis_mode == 'Fourier sideband':
+        vis, pha = zip(*[spectral_process(pattern_data, slit_width, wavelen, dist_2) for pattern_data in data])
+    else: # Fits started from the previous pattern of the sweep
+        results, counts = sweep_process(data, slit_width, wavelen, dist_2, avg_intensity)
+        vis, pha = zip(*results)
+        logger.info('Envelope fits of %d patterns: %d iterations, %d function evaluations, %d warm starts kept', len(data), counts['nit'], 
+                    counts['nfev'], counts['warm'])
+
+    err = [np.nan for pattern_data in data]
+    if error_mode in ('Jackknife', 'Bootstrap'):
+        for i, pattern_groups in enumerate(groups):
+            if pattern_groups is not None:
+                err[i] = visibility_error(data[i], pattern_groups, analysis_mode, error_mode, slit_width, wavelen, dist_2, avg_intensity)
+
+    return list(zip(slits_dist, filter_width, filter_type, vis, pha, err))
+
+def analysis_task(task):
+    """ Analyze a chunk of patterns of a store (function executed by the processes of the pool in analyze_patterns)
+    Arguments:
+        task: tuple (folder, names, analysis_mode, error_mode, avg_intensity), the patterns being in the same store
+    Returns:
+        results: list with a tuple (slits_dist, filter_width, filter_type, vis, pha, err) for each pattern (see analyze_data)
+    """
+    folder, names, analysis_mode, error_mode, avg_intensity = task
+    data = [read_pattern(folder, name) for name in names]
+
+    if error_mode in ('Jackknife', 'Bootstrap'):
+        groups = [read_statistics(folder, name)[1] for name in names]
+    else:
+        groups = [None for name in names]
+
+    return analyze_data(data, groups, read_config(folder, names[0]), analysis_mode, error_mode, avg_intensity)
+
+def analyze_patterns(folder, names, analysis_mode = 'Envelope fit', workers = 1, avg_intensity = None, chunk_size = 16, error_mode = 'None'):
+    """ Analyze a list of patterns on a pool of processes. The patterns are sent to the processes in chunks, and only a few chunks per process 
+    are submitted ahead of the results, so that when the generator is closed (or the calling process is stopped) little work is lost and the
+    pending chunks are cancelled
+    Arguments:
+        folder: path of the folder with the patterns
+        names: list of the names of the patterns (each is analyzed with the configuration of its store)
+        analysis_mode: a string, 'Envelope fit', 'Batch envelope fit' (the same fit, for a whole chunk at once) or 'Fourier sideband', determines the
+        visibility estimator
+        workers: number of worker processes (1 to analyze the patterns in the calling process)
+        avg_intensity: average intensity of the speckle fields (read from numbers.txt if not given)
+        chunk_size: number of patterns analyzed by a process for each task
+        error_mode: a string, 'None', 'Jackknife' or 'Bootstrap', determines how the standard error of the visibility is estimated (see visibility_error)
+    Returns:
+        results: generator yielding a tuple (slits_dist, filter_width, filter_type, vis, pha, err) for each pattern, in order
+    """
+
+    if avg_intensity is None and analysis_mode != 'Fourier sideband':
+        with open('numbers.txt', 'r') as f: # Read once here rather than once per pattern
+            avg_intensity = float(f.read())
+
+    # The chunks do not mix patterns of different stores, which may have different configurations
+    stores = {name: path for path in pattern_stores(folder) for name in read_header(path)['names']}
+    chunks = []
+    for name in names:
+        if chunks and len(chunks[-1]) < chunk_size and stores.get(name) == stores.get(chunks[-1][0]):
+            chunks[-1].append(name)
+        else:
+            chunks.append([name])
+    tasks = ((folder, chunk, analysis_mode, error_mode, avg_intensity) for chunk in chunks)
+
+    if workers == 1:
+        for task in tasks:
+            yield from analysis_task(task)
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque(executor.submit(analysis_task, task) for task in islice(tasks, 2 * workers))
+        try:
+            while pending:
+                results = pending.popleft().result()
+                for task in islice(tasks, 1): # Keep the pool busy with one new chunk for each one collected
+                    pending.append(executor.submit(analysis_task, task))
+                yield from results
+        finally:
+            for future in pending: # Only reached before the end if the generator is closed early
+                future.cancel()
+
+# Streaming pipeline: the fields go through generation, filtering, propagation and accumulation in batches, and only the sums of the patterns are
+# kept in memory. Saving the fields or the patterns is an optional stage of the chain, nothing is written to disk otherwise.
+
+def field_batches(fields, batch_size = 64):
+    """ Group a stream of fields in batches
+    Arguments:
+        fields: iterable of tuples (field, screen), e.g. as given by generate_speckle_fields
+        batch_size: number of fields per batch
+    Returns:
+        batches: generator yielding a tuple (batch, screen) for each batch, with a numpy array of at most batch_size fields (one per row)
+    """
+    batch = []
+    for field, screen in fields:
+        batch.append(field)
+        if len(batch) == batch_size:
+            yield np.array(batch), screen
+            batch = []
+
+    if batch:
+        yield np.array(batch), screen
+
+def save_fields(batches, folder, field_num, config, header):
+    """ Save a stream of batches of fields in the binary store of the ensemble (replacing the previous one), passing them on unchanged
+    Arguments:
+        batches: iterable of tuples (batch, screen), as given by field_batches
+        folder: path of the folder containing the speckle fields
+        field_num: number of fields of the ensemble
+        config: SimulationConfig of the fields
+        header: dictionary with the other parameters of the generation
+    Returns:
+        batches: generator yielding the same tuples (batch, screen)
+    """
+    store = None
+    start = 0
+    for batch, screen in batches:
+        if store is None:
+            store, header = create_speckle_store(folder, field_num, config, header)
+        store[start:start + len(batch)] = batch
+        start += len(batch)
+        store.flush()
+        header['complete'] = start
+        write_header(speckle_store(folder), header)
+        yield batch, screen
+
+def stream_patterns(batches, config, filter_type, filter_widths, slits_dists, groups = 10):
+    """ Filter a stream of batches of fields and propagate them through the double slit, for every point of a sweep, accumulating the sums of the 
+    interference patterns over groups of fields (the fields are not kept)
+    Arguments:
+        batches: iterable of tuples (batch, screen), as given by field_batches
+        config: SimulationConfig of the fields
+        filter_type: a string, either 'Gaussian' or 'Rectangular', determines the type of filtering
+        filter_widths: list of the filter widths of the sweep
+        slits_dists: list of the slit separations of the sweep in [mm]
+        groups: number of groups of fields (see group_matrix)
+    Returns:
+        progress: generator yielding a tuple (count, avg_intensity, pattern_groups) after each batch, with the number of fields so far, the sum over 
+        them of their average intensity (as in numbers.txt) and the array (points x groups x screen) with the partial sums of the patterns, filter 
+        widths first and slit separations second (as in the pattern stores). The array is updated in place
+    """
+    count = 0
+    avg_intensity = 0
+    pattern_groups = np.zeros((len(filter_widths) * len(slits_dists), groups, config.dim))
+    operators = [config.operator(slits_dist) for slits_dist in slits_dists]
+
+    for batch, screen in batches:
+        avg_intensity += np.sum(np.mean(np.abs(batch) ** 2, axis = 1))
+        members = group_matrix(count, len(batch), groups) # Group of each field of the batch
+        transf = field_spectra(batch) # The spectra are calculated once for all the filter widths
+
+        for i, filter_width in enumerate(filter_widths):
+            filt_fields = filter_spectra(filter_type, transf, filter_width, config)
+            for j, operator in enumerate(operators):
+                pattern_groups[i * len(slits_dists) + j] += members @ operator.patterns(filt_fields)
+
+        count += len(batch)
+        yield count, avg_intensity, pattern_groups
+
+def save_patterns(folder, run, config, filter_type, filter_widths, slits_dists, pattern_groups, header, ensemble = None):
+    """ Save the patterns of a sweep accumulated by stream_patterns in a binary store, with their partial sums over groups of fields, as the runs of 
+    the interference tab
+    Arguments:
+        folder: path of the folder containing the patterns
+        run: number of the run, which is part of the names of the patterns
+        config: SimulationConfig of the patterns
+        filter_type: a string, either 'Gaussian' or 'Rectangular', the type of filtering
+        filter_widths: list of the filter widths of the sweep
+        slits_dists: list of the slit separations of the sweep in [mm]
+        pattern_groups: numpy array (points x groups x screen) with the partial sums of the patterns
+        header: dictionary with other metadata of the run
+        ensemble: identity of the speckle ensemble of the fields (see create_pattern_store)
+    """
+    patterns, header = create_pattern_store(folder, run, config, filter_type, np.repeat(filter_widths, len(slits_dists)), 
+                                            np.tile(slits_dists, len(filter_widths)), header, ensemble)
+    group_store = create_statistics_store(folder, run, 'groups', pattern_groups.shape)
+
+    patterns[:] = pattern_groups.sum(axis = 1)
+    group_store[:] = pattern_groups
+    patterns.flush()
+    group_store.flush()
+
+    header['complete'] = len(pattern_groups)
+    write_header(os.path.join(folder, 'patterns_{}'.format(run)), header)
+
+def stream_analysis(config, pattern_groups, filter_type, filter_widths, slits_dists, avg_intensity, analysis_mode = 'Envelope fit', error_mode = 'None', 
+                    chunk_size = 16):
+    """ Analyze the patterns of a sweep accumulated by stream_patterns, without reading them from disk
+    Arguments:
+        config: SimulationConfig of the patterns
+        pattern_groups: numpy array (points x groups x screen) with the partial sums of the patterns
+        filter_type: a string, either 'Gaussian' or 'Rectangular', the type of filtering
+        filter_widths: list of the filter widths of the sweep
+        slits_dists: list of the slit separations of the sweep in [mm]
+        avg_intensity: average intensity of the speckle fields (sum over the fields, as in numbers.txt)
+        analysis_mode: a string, 'Envelope fit', 'Batch envelope fit' or 'Fourier sideband', determines the visibility estimator
+        error_mode: a string, 'None', 'Jackknife' or 'Bootstrap', determines how the standard error of the visibility is estimated
+        chunk_size: number of patterns analyzed together
+    Returns:
+        results: generator yielding a tuple (slits_dist, filter_width, filter_type, vis, pha, err) for each pattern, in order (see analyze_data)
+    """
+    points = [(round(float(f), 2), float(s)) for f in filter_widths for s in slits_dists] # Same rounding of the widths as in the pattern stores
+
+    for start in range(0, len(points), chunk_size):
+        data = [pd.DataFrame({
+            'screen': config.screen,
+            'pattern': pattern_groups[i].sum(axis = 0),
+            'filter_type': filter_type,
+            'filter_width': points[i][0],
+            'slits_dist': points[i][1]
+        }) for i in range(start, min(start + chunk_size, len(points)))]
+        yield from analyze_data(data, list(pattern_groups[start:start + chunk_size]), config, analysis_mode, error_mode, avg_intensity)
+
+def FWHM(vect, x_axis):
+    """ Calculate the FWHM of a peaked function
+    Arguments:
+        vect: numpy array containing the y coordinates of the function graph
+        x_axis: numpy array containing the x coordinates of the function graph
     Returns:
         FWHM: width of the function peak calculated as the full width at half maximum
     """
@@ -391,4 +1929,499 @@ def FWHM(vect, x_axis):
     else:
         FWHM = 0
 
-    return FWHM
\ No newline at end of file
+    return FWHM
+
+# Storage of the fields and of the patterns. Each run is saved as a binary store: a raw file with one contiguous array (.bin) and a small json header 
+# with the metadata (.json). The legacy csv files can still be read and imported.
+
+def write_header(path, header):
+    """ Write the json header of a binary store
+    Arguments:
+        path: path of the store, without extension
+        header: dictionary with the metadata of the store
+    """
+    with open(path + '.json', 'w') as f:
+        json.dump(header, f)
+
+def read_header(path):
+    """ Read the json header of a binary store
+    Arguments:
+        path: path of the store, without extension
+    Returns:
+        header: dictionary with the metadata of the store
+    """
+    with open(path + '.json', 'r') as f:
+        return json.load(f)
+
+def create_store(path, shape, dtype, header):
+    """ Create a binary store and its header
+    Arguments:
+        path: path of the store, without extension
+        shape: shape of the array
+        dtype: numpy data type of the array (complex64 or complex128 for the fields, float64 for the patterns)
+        header: dictionary with the metadata of the run
+    Returns:
+        (data, header): tuple with the array, memory mapped on the file (write into it and flush), and the complete header
+    """
+    header = dict(header, dtype = np.dtype(dtype).name, shape = list(shape))
+    write_header(path, header)
+    data = np.memmap(path + '.bin', dtype = header['dtype'], mode = 'w+', shape = tuple(shape))
+    return data, header
+
+def open_store(path, mode = 'r'):
+    """ Open a binary store
+    Arguments:
+        path: path of the store, without extension
+        mode: 'r' to read only, 'r+' to modify the array
+    Returns:
+        (data, header): tuple with the array, memory mapped on the file, and the header
+    """
+    header = read_header(path)
+    data = np.memmap(path + '.bin', dtype = header['dtype'], mode = mode, shape = tuple(header['shape']))
+    return data, header
+
+def screen_header(screen):
+    """ Describe the coordinates of the screen in a header (they are equally spaced, so the extremes and the number of points are enough)
+    Arguments:
+        screen: coordinates of the points on the screen in [cm]
+    Returns:
+        list [first point, last point, number of points]
+    """
+    return [float(screen[0]), float(screen[-1]), len(screen)]
+
+def header_screen(header):
+    """ Rebuild the coordinates of the screen from a header
+    Arguments:
+        header: dictionary with the metadata of a store
+    Returns:
+        screen: coordinates of the points on the screen in [cm]
+    """
+    start, stop, dim = header['screen']
+    return np.linspace(start, stop, dim)
+
+def speckle_store(folder):
+    """ Path of the binary store of the speckle ensemble in a folder """
+    return os.path.join(folder, 'speckles')
+
+def create_speckle_store(folder, field_num, config, header, dtype = np.complex128):
+    """ Create the binary store of a speckle ensemble, replacing the previous one
+    Arguments:
+        folder: path of the folder containing the speckle fields
+        field_num: number of fields of the ensemble
+        config: SimulationConfig of the fields
+        header: dictionary with the other parameters of the generation
+        dtype: numpy data type used to store the fields, complex64 or complex128
+    Returns:
+        (fields, header): tuple with the array of the fields (one per row, to be filled) and the complete header. Once a field has been written, flush 
+        the array, increase header['complete'] and call write_header, so that the field is part of the ensemble
+    """
+    header = dict(header, screen = screen_header(config.screen), config = config.header(), complete = 0)
+    return create_store(speckle_store(folder), (field_num, config.dim), dtype, header)
+
+def speckle_count(header):
+    """ Number of fields of the ensemble which have been written completely (the rows after them are left over from an interrupted generation)
+    Arguments:
+        header: header of the store of the speckle fields
+    Returns:
+        count: number of complete fields (all the rows for the stores written before the count was recorded)
+    """
+    return header.get('complete', header['shape'][0])
+
+def append_speckle_store(folder, field_num):
+    """ Extend the binary store of a speckle ensemble with room for new fields (the fields already stored are left untouched)
+    Arguments:
+        folder: path of the folder containing the speckle fields
+        field_num: number of fields to add
+    Returns:
+        (fields, header, first): tuple with the array of all the fields (one per row, the new ones to be filled from row first on), the updated header 
+        and the number of fields stored before (the rows of an interrupted generation are overwritten)
+    """
+    path = speckle_store(folder)
+    header = read_header(path)
+    first, dim = speckle_count(header), header['shape'][1]
+
+    with open(path + '.bin', 'r+b') as f: # The file is extended with zeros (or cut to the complete fields)
+        f.truncate((first + field_num) * dim * np.dtype(header['dtype']).itemsize)
+
+    header['shape'] = [first + field_num, dim]
+    header['complete'] = first
+    write_header(path, header)
+    fields, header = open_store(path, mode = 'r+')
+    return fields, header, first
+
+def load_csv_speckles(folder):
+    """ Read all the speckle fields stored as csv files (legacy format) in a folder into a single contiguous array
+    Arguments:
+        folder: path of the folder containing the csv files of the speckle fields
+    Returns:
+        (fields, screen): tuple of a numpy array with one speckle field per row and a numpy array containing the coordinates of the points on the screen in [cm]
+    """
+
+    names = [n for n in os.listdir(folder) if n.endswith('.csv')]
+    fields = None
+
+    for i, name in enumerate(names):
+        field_data = pd.read_csv(os.path.join(folder, name)) # Read the csv with the speckle field 
+        if fields is None:
+            fields = np.empty((len(names), len(field_data)), dtype = complex)
+            screen = field_data['screen'].to_numpy()
+        fields[i] = field_data['spec_re'].to_numpy() + field_data['spec_im'].to_numpy() * 1j # Convert to ndarray
+
+    return fields, screen
+
+def import_csv_speckles(folder, dtype = np.complex128):
+    """ Convert the speckle fields stored as csv files (legacy format) in a folder to a binary store; the csv files are left untouched
+    Arguments:
+        folder: path of the folder containing the csv files of the speckle fields
+        dtype: numpy data type used to store the fields, complex64 or complex128
+    """
+    csv_fields, screen = load_csv_speckles(folder)
+    config = SimulationConfig.from_header({'screen': screen_header(screen)}) # Default geometry on the grid of the fields
+    fields, header = create_speckle_store(folder, len(csv_fields), config, {'source': 'csv'}, dtype)
+    fields[:] = csv_fields
+    fields.flush()
+    header['complete'] = len(csv_fields)
+    write_header(speckle_store(folder), header)
+
+def open_speckles(folder):
+    """ Open the whole speckle ensemble stored in a folder as a single (fields x screen) array, memory mapped on the binary store. Rows and blocks of rows 
+    are views of the file, not copies: the ensemble can be larger than the memory, and several processes which open it share the same page cache
+    Arguments:
+        folder: path of the folder containing the speckle fields (binary store, or csv files if there is none, which are read in memory)
+    Returns:
+        (fields, screen): tuple of a numpy array with one speckle field per row and a numpy array containing the coordinates of the points on the screen in [cm]
+    """
+    if not os.path.exists(speckle_store(folder) + '.json'):
+        return load_csv_speckles(folder)
+
+    fields, header = open_store(speckle_store(folder))
+    return fields[:speckle_count(header)], header_screen(header)
+
+def ensemble_config(folder):
+    """ Configuration of the speckle ensemble stored in a folder
+    Arguments:
+        folder: path of the folder containing the speckle fields
+    Returns:
+        config: SimulationConfig of the fields (the default geometry on their grid for the csv fields)
+    """
+    if not os.path.exists(speckle_store(folder) + '.json'):
+        return SimulationConfig.from_header({'screen': screen_header(load_csv_speckles(folder)[1])})
+
+    return SimulationConfig.from_header(read_header(speckle_store(folder)))
+
+def ensemble_key(folder):
+    """ Identify the version of the speckle ensemble stored in a folder (it changes whenever the ensemble is written again)
+    Arguments:
+        folder: path of the folder containing the speckle fields
+    Returns:
+        key: list with the modification time and the size of the binary store and the number of complete fields, or None for csv fields
+    """
+    if not os.path.exists(speckle_store(folder) + '.json'):
+        return None
+
+    stat = os.stat(speckle_store(folder) + '.bin')
+    return [stat.st_mtime_ns, stat.st_size, speckle_count(read_header(speckle_store(folder)))]
+
+def ensemble_identity(folder):
+    """ Identify the speckle ensemble stored in a folder across its extensions: the generator and the seed, which determine all its fields. It is written
+    in the headers of the patterns calculated from the ensemble, so that only these are updated when new fields are added to it
+    Arguments:
+        folder: path of the folder containing the speckle fields
+    Returns:
+        identity: dictionary with the generator mode and the seed of the fields, or None if the ensemble cannot be continued (csv fields, or stores 
+        written before the seed was recorded)
+    """
+    if not os.path.exists(speckle_store(folder) + '.json'):
+        return None
+
+    header = read_header(speckle_store(folder))
+    if 'generator_mode' not in header or 'seed' not in header:
+        return None
+    return {'generator_mode': header['generator_mode'], 'seed': header['seed']}
+
+def list_speckles(folder):
+    """ List the names of the speckle fields stored in a folder
+    Arguments:
+        folder: path of the folder containing the speckle fields
+    Returns:
+        names: list of strings with the names of the fields
+    """
+    if not os.path.exists(speckle_store(folder) + '.json'):
+        return [n for n in os.listdir(folder) if n.endswith('.csv')]
+
+    header = read_header(speckle_store(folder))
+    return ['speckle_num_{}'.format(i) for i in range(speckle_count(header))]
+
+def read_speckle(folder, name):
+    """ Read a single speckle field
+    Arguments:
+        folder: path of the folder containing the speckle fields
+        name: name of the field, as given by list_speckles
+    Returns:
+        (field, screen): tuple of a numpy array containing the speckle field (read only) and a numpy array containing the coordinates of the points on the screen in [cm]
+    """
+    if name.endswith('.csv'):
+        field_data = pd.read_csv(os.path.join(folder, name))
+        return field_data['spec_re'].to_numpy() + field_data['spec_im'].to_numpy() * 1j, field_data['screen'].to_numpy()
+
+    fields, screen = open_speckles(folder)
+    return fields[int(name.split('_')[-1])], screen # View of the field in the store
+
+def pattern_stores(folder):
+    """ List the paths of the binary stores of the patterns in a folder (one per run)
+    Arguments:
+        folder: path of the folder containing the patterns
+    Returns:
+        paths: list of strings with the paths of the stores, without extension
+    """
+    return [os.path.join(folder, n[:-len('.json')]) for n in sorted(os.listdir(folder)) if n.endswith('.json')]
+
+def create_pattern_store(folder, run, config, filter_type, filter_width, slits_dist, header, ensemble = None):
+    """ Create the binary store of the patterns of a run, one for each point of the sweep
+    Arguments:
+        folder: path of the folder containing the patterns
+        run: number of the run, which is part of the names of the patterns
+        config: SimulationConfig of the patterns
+        filter_type: a string, either 'Gaussian' or 'Rectangular', the type of filtering of the run
+        filter_width: list with the filter width of each pattern
+        slits_dist: list with the slit separation of each pattern in [mm]
+        header: dictionary with other metadata of the run
+        ensemble: identity of the speckle ensemble of the fields, as given by ensemble_identity (None if the patterns are not tied to a stored 
+            ensemble, and are never updated with new fields)
+    Returns:
+        (patterns, header): tuple with the array of the patterns (one per row, to be filled) and the complete header. Once a pattern has been written, 
+        increase header['complete'] and call write_header, so that it is listed by list_patterns
+    """
+    num = len(filter_width)
+    path = os.path.join(folder, 'patterns_{}'.format(run))
+
+    for kind in ('variance', 'groups'): # Remove the statistics of a previous run with the same number
+        for ext in ('.json', '.bin'):
+            if os.path.exists(statistics_path(path, kind) + ext):
+                os.remove(statistics_path(path, kind) + ext)
+
+    header = dict(header, 
+        screen = screen_header(config.screen), 
+        config = config.header(), 
+        names = ['Pattern_{}_{}'.format(run, i + 1) for i in range(num)],
+        filter_type = [filter_type for i in range(num)],
+        filter_width = [round(float(f), 2) for f in filter_width],
+        filter_width_exact = [float(f) for f in filter_width], # The widths actually used, to add new fields with the same filters
+        slits_dist = [float(s) for s in slits_dist],
+        ensemble_id = ensemble,
+        complete = 0
+    )
+    return create_store(path, (num, config.dim), np.float64, header)
+
+def statistics_path(path, kind):
+    """ Path of the store of the statistics of a run of patterns: 'variance' (variance over the fields, for each pattern) or 'groups' (partial sums of 
+    each pattern over groups of fields), kept in a subfolder of the patterns
+    Arguments:
+        path: path of the store of the patterns, without extension
+        kind: a string, either 'variance' or 'groups'
+    Returns:
+        path of the store of the statistics, without extension
+    """
+    return os.path.join(os.path.dirname(path), kind, os.path.basename(path))
+
+def create_statistics_store(folder, run, kind, shape):
+    """ Create the store of the statistics of a run of patterns (see statistics_path)
+    Arguments:
+        folder: path of the folder containing the patterns
+        run: number of the run
+        kind: a string, either 'variance' or 'groups'
+        shape: shape of the array, (patterns x screen) for the variance, (patterns x groups x screen) for the groups
+    Returns:
+        data: the array, memory mapped on the file (write into it and flush)
+    """
+    os.makedirs(os.path.join(folder, kind), exist_ok = True)
+    return create_store(statistics_path(os.path.join(folder, 'patterns_{}'.format(run)), kind), shape, np.float64, {})[0]
+
+def find_pattern(folder, name):
+    """ Find the store of the patterns which contains a pattern
+    Arguments:
+        folder: path of the folder containing the patterns
+        name: name of the pattern, as given by list_patterns
+    Returns:
+        (path, i): tuple with the path of the store, without extension, and the row of the pattern
+    """
+    for path in pattern_stores(folder):
+        header = read_header(path)
+        if name in header['names']:
+            return path, header['names'].index(name)
+
+    raise FileNotFoundError('Pattern {} not found in {}'.format(name, folder))
+
+def read_config(folder, name):
+    """ Configuration with which a pattern was calculated
+    Arguments:
+        folder: path of the folder containing the patterns
+        name: name of the pattern, as given by list_patterns
+    Returns:
+        config: SimulationConfig of the pattern (the default geometry on its grid for the csv patterns)
+    """
+    if name.endswith('.csv'):
+        return SimulationConfig.from_header({'screen': screen_header(pd.read_csv(os.path.join(folder, name))['screen'].to_numpy())})
+
+    return SimulationConfig.from_header(read_header(find_pattern(folder, name)[0]))
+
+def read_statistics(folder, name):
+    """ Read the statistics of a single pattern over the fields of the ensemble
+    Arguments:
+        folder: path of the folder containing the patterns
+        name: name of the pattern, as given by list_patterns
+    Returns:
+        (variance, groups): tuple with a numpy array with the variance over the fields of the pattern on each point of the screen and a numpy array with
+        the partial sums of the pattern over the groups of fields (one per row); each is None if it was not stored (csv patterns, or patterns calculated
+        from the coherence matrix, which have no variance)
+    """
+    if name.endswith('.csv'):
+        return None, None
+
+    path, i = find_pattern(folder, name)
+    stats = []
+    for kind in ('variance', 'groups'):
+        if os.path.exists(statistics_path(path, kind) + '.json'):
+            stats.append(np.array(open_store(statistics_path(path, kind))[0][i]))
+        else:
+            stats.append(None)
+
+    return tuple(stats)
+
+def update_patterns(folder, fields, first, ensemble, block = 64):
+    """ Add the contribution of new speckle fields to the patterns (sums over the fields of the ensemble) of every run which was calculated with the 
+    previous fields of the ensemble, so that the patterns need not be calculated again from all the fields; their statistics over the fields (variance
+    and partial sums over groups of fields), if stored, are updated too. Each run is updated with its own configuration; runs calculated from another 
+    ensemble (or with a different number of fields, or on a different grid) are left untouched
+    Arguments:
+        folder: path of the folder containing the patterns
+        fields: numpy array with the new speckle fields, one per row
+        first: number of fields of the ensemble before the new ones
+        ensemble: identity of the ensemble, as given by ensemble_identity (if None no run is updated)
+        block: number of fields filtered together
+    Returns:
+        progress: generator yielding (updated, total), the number of patterns updated so far and the number of patterns to update, after each filter
+    """
+    headers = {path: read_header(path) for path in pattern_stores(folder)}
+    # Runs with an adaptive number of fields (field_count) are complete at the precision requested, and are not updated
+    paths = [path for path, header in headers.items() if ensemble is not None and header.get('ensemble_id') == ensemble 
+             and header.get('field_num') == first and 'filter_width_exact' in header and 'field_count' not in header and header['shape'][1] == fields.shape[1]]
+    total = sum(headers[path]['complete'] for path in paths)
+    updated = 0
+
+    for path in paths:
+        patterns, header = open_store(path, mode = 'r+')
+        config = SimulationConfig.from_header(header)
+        rows = range(header['complete'])
+        added = np.zeros((len(rows), config.dim))
+
+        stats = {kind: open_store(statistics_path(path, kind), mode = 'r+')[0] for kind in ('variance', 'groups') 
+                 if os.path.exists(statistics_path(path, kind) + '.json')}
+        if 'variance' in stats: # Streaming statistics of each pattern, continued from the stored ones
+            count = [first for i in rows]
+            mean = [patterns[i] / first for i in rows]
+            m2 = [stats['variance'][i] * (first - 1) for i in rows]
+
+        # The rows which share the same filter are updated together, filtering the new fields only once
+        filters = {}
+        for i in rows:
+            filters.setdefault((header['filter_type'][i], header['filter_width_exact'][i]), []).append(i)
+
+        for (filter_type, filter_width), group in filters.items():
+            operators = [config.operator(header['slits_dist'][i]) for i in group]
+            for start in range(0, len(fields), block):
+                filt_fields = filter_spectra(filter_type, field_spectra(fields[start:start + block]), filter_width, config)
+                for i, operator in zip(group, operators):
+                    if stats: # The statistics need the pattern of each field
+                        field_patterns = operator.patterns(filt_fields)
+                        added[i] += field_patterns.sum(axis = 0)
+                        if 'groups' in stats:
+                            stats['groups'][i] += group_matrix(first + start, len(filt_fields), stats['groups'].shape[1]) @ field_patterns
+                        if 'variance' in stats:
+                            count[i], mean[i], m2[i] = welford_update(count[i], mean[i], m2[i], field_patterns)
+                    else:
+                        added[i] += operator.coherence_pattern(operator.coherence(filt_fields))
+            updated += len(group)
+            yield updated, total
+
+        patterns[:len(rows)] += added
+        patterns.flush()
+        if 'variance' in stats:
+            for i in rows:
+                stats['variance'][i] = m2[i] / max(count[i] - 1, 1)
+        for data in stats.values():
+            data.flush()
+        header['field_num'] = first + len(fields)
+        write_header(path, header)
+
+def detach_patterns(folder):
+    """ Detach the runs of patterns from the speckle ensemble they were calculated from, when the ensemble is replaced by a new one: the runs are kept 
+    and can still be analyzed, but they are never updated with the fields of the new ensemble (see update_patterns)
+    Arguments:
+        folder: path of the folder containing the patterns
+    """
+    for path in pattern_stores(folder):
+        header = read_header(path)
+        if header.get('ensemble_id') is not None:
+            header['ensemble_id'] = None
+            write_header(path, header)
+
+def import_csv_patterns(folder, run):
+    """ Convert the patterns stored as csv files (legacy format) in a folder to a binary store; the csv files are left untouched
+    Arguments:
+        folder: path of the folder containing the csv files of the patterns
+        run: number of the run of the new store (choose one that is not used yet)
+    """
+    names = [n for n in sorted(os.listdir(folder)) if n.endswith('.csv')]
+    data = [pd.read_csv(os.path.join(folder, n)) for n in names]
+    config = SimulationConfig.from_header({'screen': screen_header(data[0]['screen'].to_numpy())}) # Default geometry on the grid of the patterns
+    patterns, header = create_pattern_store(folder, run, config, data[0]['filter_type'][0], 
+                                            [d['filter_width'][0] for d in data], [d['slits_dist'][0] for d in data], {'source': 'csv'})
+    header['filter_type'] = [d['filter_type'][0] for d in data]
+    header['names'] = [n[:-len('.csv')] for n in names]
+    for i, d in enumerate(data):
+        patterns[i] = d['pattern'].to_numpy()
+    patterns.flush()
+    header['complete'] = len(data)
+    write_header(os.path.join(folder, 'patterns_{}'.format(run)), header)
+
+def list_patterns(folder):
+    """ List the names of the (complete) patterns stored in a folder, both in binary stores and in csv files
+    Arguments:
+        folder: path of the folder containing the patterns
+    Returns:
+        names: list of strings with the names of the patterns
+    """
+    names = []
+    for path in pattern_stores(folder):
+        header = read_header(path)
+        names += header['names'][:header['complete']]
+
+    return names + [n for n in sorted(os.listdir(folder)) if n.endswith('.csv')]
+
+def read_pattern(folder, name):
+    """ Read a single pattern
+    Arguments:
+        folder: path of the folder containing the patterns
+        name: name of the pattern, as given by list_patterns
+    Returns:
+        pattern_data: pandas dataframe with the screen coordinates in [cm], the interference pattern, the filter type, the filter width and the slit separation
+        (and the number of fields summed, for the runs with an adaptive number of fields)
+    """
+    if name.endswith('.csv'):
+        return pd.read_csv(os.path.join(folder, name))
+
+    path, i = find_pattern(folder, name)
+    patterns, header = open_store(path)
+    pattern_data = pd.DataFrame({
+        'screen': header_screen(header),
+        'pattern': np.array(patterns[i]),
+        'filter_type': header['filter_type'][i],
+        'filter_width': header['filter_width'][i],
+        'slits_dist': header['slits_dist'][i]
+    })
+
+    if 'field_count' in header: # Number of fields actually summed, for the runs with an adaptive number of fields
+        pattern_data['field_count'] = header['field_count'][i]
+
+    return pattern_data